@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+aln_index.py
+
+Byte-offset index of a CLUSTAL .aln file, so that clustal_to_grishin.py can list the
+ids and pull any pair of aligned sequences out of a very large alignment with a few
+slices of the memory-mapped file instead of reading all of it.
+
+CLUSTAL writes every sequence once per block, in the same order in every block, and
+Clustal Omega pads the ids so that all the lines of a block have the same layout. The
+index records, for each block, the byte offset of its first sequence line, the distance
+between two sequence lines and the column and length of the aligned fragment; the line
+of a sequence within a block is its position in the id list. Fragment i of sequence k is
+then bytes offset + k * stride + start .. + length. Alignments whose blocks do not have
+that layout (sequences missing from a block, residue counts of varying width after the
+fragments) cannot be indexed, and are read line by line as before.
+
+The index is a sidecar <aln>.idx:
+
+  header  '<8sHHIIQq32s': magic, format version, reserved, number of ids, number of
+          blocks, size, mtime (ns) and SHA-256 of the .aln it was built from
+  blocks  number of blocks * '<4q': offset, stride, start, length
+  ids     the ids in block order, utf-8, one per line
+
+An index is used when the size and mtime of the .aln match it, or, when only the mtime
+differs (the file was copied), when its SHA-256 does.
+
+Example:
+  $ python aln_index.py family.aln
+  $ python clustal_to_grishin.py family.aln --list-ids     # picks family.aln.idx up
+  >>> import aln_index
+  >>> index = aln_index.load_index("family.aln")
+  >>> index.sequences(["COX3gg", "COX3hs"])
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAGIC = b"ALNINDEX"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sHHIIQq32s")
+# offset, stride, start, length
+BLOCK = struct.Struct("<4q")
+
+Block = Tuple[int, int, int, int]
+
+
+def index_name(aln_path: str) -> str:
+    return aln_path + ".idx"
+
+
+def file_sha256(path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def _sequence_lines(data: bytes) -> Iterable[tuple[int, int, int, bytes, bool]]:
+    """
+    Yield (offset, start, length, id, new_block) for every sequence line of a CLUSTAL .aln,
+    following the rules of clustal_to_grishin.clustal_fragments(). new_block is True for
+    the first sequence line after a header, empty or consensus line.
+    """
+    offset = 0
+    in_block = False
+    size = len(data)
+    while offset < size:
+        end = data.find(b"\n", offset)
+        end = size if end < 0 else end + 1
+        line = data[offset:end]
+        if not line.strip() or line.startswith((b"CLUSTAL", b"MUSCLE")) or line[:1].isspace():
+            in_block = False
+        else:
+            parts = line.split(None, 2)
+            if len(parts) >= 2 and not parts[1].isdigit():
+                start = line.index(parts[1], len(parts[0]))
+                yield offset, start, len(parts[1]), parts[0], not in_block
+                in_block = True
+        offset = end
+
+
+def build_index(data: bytes):
+    """
+    Index the bytes of a CLUSTAL .aln. Returns (ids, blocks), blocks a list of
+    (offset, stride, start, length) tuples. Raises ValueError when the blocks do not have
+    the same ids in the same order with the same line layout (see the module docstring).
+    """
+    ids: List[bytes] = []
+    blocks: List[List[int]] = []
+    first_block = True
+    position = 0
+    for offset, start, length, seq_id, new_block in _sequence_lines(data):
+        if new_block:
+            if blocks and position != len(ids):
+                raise ValueError("block %d has %d sequences instead of %d" % (len(blocks), position, len(ids)))
+            first_block = not blocks
+            blocks.append([offset, 0, start, length])
+            position = 0
+        block = blocks[-1]
+        if first_block:
+            ids.append(seq_id)
+        elif position >= len(ids) or ids[position] != seq_id:
+            raise ValueError("block %d does not list the sequences in the order of the first" % (len(blocks) - 1))
+        if position == 1:
+            block[1] = offset - block[0]
+        if offset != block[0] + position * block[1] or start != block[2] or length != block[3]:
+            raise ValueError("the lines of block %d do not have the same layout" % (len(blocks) - 1))
+        position += 1
+    if blocks and position != len(ids):
+        raise ValueError("block %d has %d sequences instead of %d" % (len(blocks) - 1, position, len(ids)))
+    if len(set(ids)) != len(ids):
+        raise ValueError("repeated sequence ids in a block")
+    return [seq_id.decode("utf-8") for seq_id in ids], [tuple(block) for block in blocks]
+
+
+def write_index(aln_path: str, path: Optional[str] = None) -> "AlnIndex":
+    """Build the index of aln_path and write it to path (default: <aln>.idx), atomically."""
+    path = path or index_name(aln_path)
+    stat = os.stat(aln_path)
+    with open(aln_path, "rb") as fh:
+        data = fh.read()
+    ids, blocks = build_index(data)
+    digest = hashlib.sha256(data).digest()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(ids), len(blocks), stat.st_size, stat.st_mtime_ns, digest))
+        fh.write(b"".join(BLOCK.pack(*block) for block in blocks))
+        fh.write("\n".join(ids).encode("utf-8"))
+    os.replace(tmp, path)
+    return AlnIndex(aln_path, ids, blocks)
+
+
+class AlnIndex:
+    """The index of one .aln: ids in file order and the block table (see build_index())."""
+
+    def __init__(self, aln_path: str, ids: List[str], blocks: List[Block]):
+        self.aln_path = aln_path
+        self.ids = ids
+        self.blocks = blocks
+        self.positions: Dict[str, int] = {seq_id: i for i, seq_id in enumerate(ids)}
+        self._data: Optional[mmap.mmap] = None
+
+    def _map(self) -> mmap.mmap:
+        if self._data is None:
+            with open(self.aln_path, "rb") as fh:
+                self._data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._data
+
+    def sequence(self, seq_id: str) -> str:
+        """The aligned sequence of seq_id (KeyError when it is not in the alignment)."""
+        position = self.positions[seq_id]
+        data = self._map()
+        fragments = []
+        for offset, stride, start, length in self.blocks:
+            begin = offset + position * stride + start
+            fragments.append(data[begin : begin + length])
+        return b"".join(fragments).decode("utf-8")
+
+    def sequences(self, keep: Iterable[str]) -> Dict[str, str]:
+        """{id: aligned sequence} for the ids of keep found in the alignment, in file order."""
+        wanted = sorted((self.positions[seq_id], seq_id) for seq_id in set(keep) if seq_id in self.positions)
+        return {seq_id: self.sequence(seq_id) for _, seq_id in wanted}
+
+
+def load_index(aln_path: str, path: Optional[str] = None) -> Optional[AlnIndex]:
+    """
+    The index of aln_path, or None when there is none or it was built from another version
+    of the file. A broken index is reported on stderr and ignored.
+    """
+    path = path or index_name(aln_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        if len(data) < HEADER.size:
+            raise ValueError("truncated index")
+        magic, version, _, n_ids, n_blocks, size, mtime_ns, digest = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("not a version %d alignment index" % FORMAT_VERSION)
+        stat = os.stat(aln_path)
+        if stat.st_size != size:
+            return None
+        if stat.st_mtime_ns != mtime_ns and file_sha256(aln_path) != digest:
+            return None
+        end = HEADER.size + n_blocks * BLOCK.size
+        if len(data) < end:
+            raise ValueError("truncated index")
+        blocks = list(BLOCK.iter_unpack(data[HEADER.size : end]))
+        ids = data[end:].decode("utf-8").split("\n") if n_ids else []
+        if len(ids) != n_ids:
+            raise ValueError("truncated index")
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        print(f"Ignoring alignment index {path}: {e}", file=sys.stderr)
+        return None
+    return AlnIndex(aln_path, ids, blocks)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(
+        description="Build the byte-offset index (<aln>.idx) of CLUSTAL .aln files for clustal_to_grishin.py."
+    )
+    ap.add_argument("alignments", nargs="+", help="CLUSTAL .aln files")
+    args = ap.parse_args()
+
+    failed = 0
+    for aln_path in args.alignments:
+        try:
+            index = write_index(aln_path)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: cannot index {aln_path}: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        print(f"Wrote {index_name(aln_path)}: {len(index.ids)} sequences in {len(index.blocks)} blocks")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+atom_table.py
+
+Columnar NumPy backend for clean_pdb.py (selected with --backend numpy).
+
+The ATOM/HETATM records of the first model are parsed once into a fixed-width byte
+matrix, viewed as a NumPy structured array of the PDB columns. The modres mapping,
+altloc selection, backbone/occupancy check and renumbering then run as vectorized
+masks and column writes instead of re-slicing every line in Python.
+
+The output (cleaned PDB text, fasta sequences and the ALT/INS/MOD/DNS flags) is
+identical to the line-by-line path of clean_pdb.py, including its quirks: residues
+are delimited by a change of the residue number columns only, and occupancy is read
+from columns 56-60.
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from amino_acids import longer_names
+from ccd_index import modres_table
+
+modres = modres_table()
+
+# (name, numpy format, 0-based start column) of the fields read from each record
+ATOM_COLUMNS = [
+    ("record", "S6", 0),
+    ("name", "S4", 12),
+    ("altloc", "S1", 16),
+    ("resn", "S3", 17),
+    ("chain", "S1", 21),
+    ("resnum", "S5", 22),  # residue number + insertion code, the residue key
+    ("icode", "S1", 26),
+    ("occupancy", "S5", 55),
+    ("element", "S2", 76),
+]
+MIN_WIDTH = 80
+
+BACKBONE = (b" N  ", b" CA ", b" C  ")
+SPACE = ord(" ")
+NEWLINE = ord("\n")
+
+
+def residue_code(names) -> np.ndarray:
+    """Pack three-letter residue names (an (n, 3) uint8 array or a list of str) into integers."""
+    if not isinstance(names, np.ndarray):
+        names = np.frombuffer("".join(names).encode("latin-1"), dtype=np.uint8).reshape(-1, 3)
+    names = names.astype(np.int64)
+    return (names[:, 0] << 16) | (names[:, 1] << 8) | names[:, 2]
+
+
+def residue_lookup(mapping: dict):
+    """Return sorted residue codes of a {three-letter name: value} dict and the matching values."""
+    keys = [k for k in mapping if len(k) == 3]
+    codes = residue_code(keys)
+    order = np.argsort(codes)
+    return codes[order], [mapping[keys[i]] for i in order]
+
+
+MODRES_CODES, MODRES_PARENTS = residue_lookup(modres)
+MODRES_PARENT_CODES = residue_code(MODRES_PARENTS)
+LETTER_CODES, LETTERS = residue_lookup(longer_names)
+LETTERS = np.frombuffer("".join(LETTERS).encode("latin-1"), dtype=np.uint8)
+
+
+def lookup(codes: np.ndarray, keys: np.ndarray):
+    """Vectorized dict lookup: (found mask, index into keys) for every code."""
+    index = np.clip(np.searchsorted(keys, codes), 0, len(keys) - 1)
+    return keys[index] == codes, index
+
+
+def gather_columns(padded: np.ndarray, starts: np.ndarray, lengths: np.ndarray, first: int, width: int) -> np.ndarray:
+    """
+    Copy columns first..first+width of each line into an (n, width) matrix, space padded.
+
+    padded is the raw text followed by at least first+width spare bytes, so that a window
+    of that size exists at every line start.
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width)
+    out = windows[starts + first]
+    columns = np.arange(first, first + width)
+    out[columns[None, :] >= lengths[:, None]] = SPACE
+    return out
+
+
+def first_model_text(lines: Iterable[str]) -> str:
+    """Return the text of an open PDB file (or iterable of lines) up to the first ENDMDL."""
+    text = lines.read() if hasattr(lines, "read") else "".join(lines)
+    if text.startswith("ENDMDL"):
+        return ""
+    end = text.find("\nENDMDL")
+    return text[: end + 1] if end >= 0 else text
+
+
+def read_atom_table(text: str, chainid: str, allchains: bool):
+    """
+    Select the ATOM/HETATM records of the requested chains and parse them into columns.
+
+    Line boundaries, record types and chain ids are found on the raw bytes, so no Python
+    code runs per line. Returns (table, matrix, lengths, newline):
+    - matrix: uint8 array (n_atoms, width) holding each record, space padded
+    - table: structured view of matrix with the fields in ATOM_COLUMNS
+    - lengths: length of each record without its line terminator
+    - newline: whether each record was terminated by a newline
+    """
+    raw = np.frombuffer(text.encode("latin-1", "replace"), dtype=np.uint8)
+    ends = np.flatnonzero(raw == NEWLINE)
+    starts = np.concatenate(([0], ends + 1))
+    ends = np.concatenate((ends, [len(raw)]))
+    lengths = ends - starts
+    newline = ends < len(raw)
+
+    width = max(MIN_WIDTH, int(lengths.max()))
+    padded = np.concatenate((raw, np.full(width, SPACE, dtype=np.uint8)))
+    head = gather_columns(padded, starts, lengths, 0, 6)
+    chain = gather_columns(padded, starts, lengths, 21, 1)[:, 0]
+    is_atom = np.all(head[:, :4] == np.frombuffer(b"ATOM", dtype=np.uint8), axis=1)
+    is_hetatm = np.all(head == np.frombuffer(b"HETATM", dtype=np.uint8), axis=1)
+    selected = (lengths + newline > 21) & (is_atom | is_hetatm)
+    if not allchains:
+        selected &= np.isin(chain, np.frombuffer(chainid.encode("latin-1"), dtype=np.uint8))
+
+    starts, lengths, newline = starts[selected], lengths[selected], newline[selected]
+    matrix = gather_columns(padded, starts, lengths, 0, width)
+    return table_view(matrix), matrix, lengths, newline
+
+
+def table_view(matrix: np.ndarray) -> np.ndarray:
+    """Structured view of a record matrix with the fields in ATOM_COLUMNS."""
+    dtype = np.dtype(
+        {
+            "names": [c[0] for c in ATOM_COLUMNS],
+            "formats": [c[1] for c in ATOM_COLUMNS],
+            "offsets": [c[2] for c in ATOM_COLUMNS],
+            "itemsize": matrix.shape[1],
+        }
+    )
+    return matrix.reshape(-1).view(dtype)
+
+
+def chain_tables(text: str, chainid: str, allchains: bool) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Parse the records of the requested chains once and split them by chain.
+
+    Returns {chain: (matrix, lengths, newline)} (see read_atom_table()), for every chain of
+    chainid in that order, absent ones included, or with allchains for every chain found,
+    in order of first appearance. Each part can be given to clean_table() on its own.
+    """
+    table, matrix, lengths, newline = read_atom_table(text, chainid, allchains)
+    if allchains:
+        found = table["chain"]
+        _, first = np.unique(found, return_index=True)
+        chains = [found[index].decode("latin-1") for index in sorted(first)]
+    else:
+        chains = list(dict.fromkeys(chainid))
+    parts = {}
+    for chain in chains:
+        rows = table["chain"] == chain.encode("latin-1")
+        parts[chain] = (matrix[rows], lengths[rows], newline[rows])
+    return parts
+
+
+def put_column(matrix: np.ndarray, rows: np.ndarray, start: int, text: str) -> None:
+    """Overwrite the same text at a fixed column of the selected rows."""
+    data = np.frombuffer(text.encode("latin-1"), dtype=np.uint8)
+    matrix[rows, start : start + len(data)] = data
+
+
+def number_columns(numbers: np.ndarray, digits: int) -> np.ndarray:
+    """Render numbers of at most `digits` digits as '%<digits>d ' into an (n, digits + 1) uint8 array."""
+    out = np.full((len(numbers), digits + 1), SPACE, dtype=np.uint8)
+    for column in range(digits):
+        power = 10 ** (digits - 1 - column)
+        digit = (numbers // power) % 10 + ord("0")
+        out[:, column] = np.where(numbers >= power, digit, SPACE)
+    return out
+
+
+def renumbered_text(matrix: np.ndarray, lengths: np.ndarray, newline: np.ndarray, numbers: np.ndarray) -> str:
+    """
+    Write '%4d ' % number into columns 23-27 of every record and join the records into text.
+
+    Numbers past 9999 widen the field and push the rest of the line right, as the string
+    slicing in clean_pdb does. Numbers never decrease along the records, so each width is
+    one contiguous run of records and the runs are rendered one after the other.
+    """
+    pieces = []
+    width = matrix.shape[1]
+    max_digits = max(4, len(str(int(numbers.max())))) if len(numbers) else 4
+    for digits in range(4, max_digits + 1):
+        run = (numbers < 10 ** digits) & ((numbers >= 10 ** (digits - 1)) | (digits == 4))
+        if not np.any(run):
+            continue
+        extra = digits - 4
+        records, length = matrix[run], np.maximum(lengths[run], 27) + extra
+        framed = np.full((len(records), width + extra + 1), NEWLINE, dtype=np.uint8)
+        framed[:, :22] = records[:, :22]
+        framed[:, 22 : 27 + extra] = number_columns(numbers[run], digits)
+        framed[:, 27 + extra : width + extra] = records[:, 27:]
+        if np.all(length == length[0]) and np.all(newline[run]):
+            # Usual case, all records equally long: the matrix bytes are the text
+            framed[:, length[0]] = NEWLINE  # records shorter than the matrix were space padded
+            pieces.append(framed[:, : length[0] + 1].tobytes().decode("latin-1"))
+            continue
+        columns = np.arange(framed.shape[1])
+        framed[columns[None, :] == length[:, None]] = NEWLINE
+        wanted = columns[None, :] < (length + newline[run])[:, None]
+        pieces.append(framed[wanted].tobytes().decode("latin-1"))
+    return "".join(pieces)
+
+
+def restore_columns(matrix: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Residue numbers of cleaned records, and the records moved back to the standard columns.
+
+    clean_pdb writes '%4d ' into columns 23-27, so numbers past 9999 widen the field and
+    push the rest of the record right. Those records are shifted back in place (their number
+    columns then hold the leading digits only). Returns (numbers, lengths).
+    """
+    if len(matrix) == 0:
+        return np.zeros(0, dtype=np.int64), lengths
+    # The number ends at the first space from column 27 on
+    extra = np.argmin(matrix[:, 26:33] != SPACE, axis=1)
+    numbers = np.zeros(len(matrix), dtype=np.int64)
+    width = matrix.shape[1]
+    for shift in np.unique(extra):
+        rows = extra == shift
+        field = np.ascontiguousarray(matrix[rows, 22 : 27 + shift]).view("S%d" % (5 + shift))
+        numbers[rows] = field[:, 0].astype(np.int64)
+        if shift:
+            matrix[rows, 27 : width - shift] = matrix[rows, 27 + shift :]
+            matrix[rows, width - shift :] = SPACE
+            lengths = np.where(rows, lengths - shift, lengths)
+    return numbers, lengths
+
+
+def clean_text(
+    text: str, chainid: str, options, counts: Optional[Dict[str, int]] = None,
+    renumbering: Optional[List[str]] = None,
+) -> Tuple[str, Dict[str, str], Dict[str, bool]]:
+    """
+    Clean the first model of a PDB the way clean_pdb.clean_lines() does, column-wise.
+
+    Returns (pdb_text, fastaseq, flags) where fastaseq maps chain -> sequence (in order of
+    first appearance) and flags has the keys 'altpos', 'insres', 'modres' and 'misdns'.
+    If counts is given (see clean_pdb.new_drop_counts), the atoms read and the residues
+    and atoms dropped are added to it. If renumbering is given, the input residue number
+    (columns 23-27) of each residue written is appended to it.
+    """
+    _, matrix, lengths, newline = read_atom_table(text, chainid, options.allchains)
+    return clean_table(matrix, lengths, newline, options, counts, renumbering)
+
+
+def clean_table(
+    matrix: np.ndarray, lengths: np.ndarray, newline: np.ndarray, options,
+    counts: Optional[Dict[str, int]] = None, renumbering: Optional[List[str]] = None,
+) -> Tuple[str, Dict[str, str], Dict[str, bool]]:
+    """
+    Clean records already parsed by read_atom_table() or chain_tables(); see clean_text().
+    The rows of matrix are edited in place.
+    """
+    flags = {"altpos": False, "insres": False, "modres": False, "misdns": False}
+    if counts is None:
+        counts = dict.fromkeys(("atoms", "missing_backbone", "zero_occupancy",
+                                "unknown_residue", "altloc_atoms"), 0)
+    table = table_view(matrix)
+    counts["atoms"] += len(table)
+
+    # Modified residues -> canonical names (looked up in ATOM and HETATM records alike)
+    resn = residue_code(matrix[:, 17:20])
+    is_mod, parent = lookup(resn, MODRES_CODES)
+    is_mse = table["resn"] == b"MSE"
+    flags["modres"] = bool(np.any(is_mod & ~is_mse))
+    resn = np.where(is_mod, MODRES_PARENT_CODES[parent], resn)
+
+    # Only residues we know are valid
+    valid, letter = lookup(resn, LETTER_CODES)
+    if not np.all(valid):
+        unknown = table[~valid]
+        counts["unknown_residue"] += int(np.count_nonzero(
+            (unknown["chain"][1:] != unknown["chain"][:-1]) | (unknown["resnum"][1:] != unknown["resnum"][:-1])
+        )) + 1
+        table, matrix, lengths, newline = table[valid], matrix[valid], lengths[valid], newline[valid]
+        is_mod, is_mse, resn, letter = is_mod[valid], is_mse[valid], resn[valid], letter[valid]
+    letter = LETTERS[letter]
+    if len(table) == 0:
+        return "", {}, flags
+
+    # A new residue starts wherever the residue number columns change
+    starts = np.ones(len(table), dtype=bool)
+    starts[1:] = table["resnum"][1:] != table["resnum"][:-1]
+    residue = np.cumsum(starts) - 1
+    residue_letter = letter[starts]
+
+    flags["insres"] = bool(np.any(table["icode"] != b" "))
+    flags["altpos"] = bool(np.any(table["altloc"] != b" "))
+
+    # Keep blank and first alternate locations only
+    keep = (table["altloc"] == b" ") | (table["altloc"] == b"A")
+    counts["altloc_atoms"] += int(np.count_nonzero(~keep))
+
+    # Backbone completeness: N, CA and C with non-zero occupancy
+    names = table["name"]
+    backbone = [keep & (names == atom) for atom in BACKBONE]
+    named = backbone
+    if not options.keepzeroocc:
+        # Only the backbone occupancies matter, so only those are parsed
+        rows = backbone[0] | backbone[1] | backbone[2]
+        occupied = np.zeros(len(table), dtype=bool)
+        occupied[rows] = table["occupancy"][rows].astype(float) > 0.0
+        backbone = [atom & occupied for atom in backbone]
+    nresidues = len(residue_letter)
+
+    def has_all(atoms):
+        found = np.ones(nresidues, dtype=bool)
+        for atom in atoms:
+            present = np.zeros(nresidues, dtype=bool)
+            present[residue[atom]] = True
+            found &= present
+        return found
+
+    complete = has_all(backbone)
+
+    buffered = np.zeros(nresidues, dtype=bool)
+    buffered[residue[keep]] = True
+    dropped = buffered & ~complete
+    flags["misdns"] = bool(np.any(dropped))
+    # Residues whose backbone atoms are all there but not all occupied
+    zero_occupancy = int(np.count_nonzero(dropped & has_all(named)))
+    counts["zero_occupancy"] += zero_occupancy
+    counts["missing_backbone"] += int(np.count_nonzero(dropped)) - zero_occupancy
+
+    rows = keep & complete[residue]
+    number = np.cumsum(complete) * complete  # new residue numbers, 0 for dropped residues
+
+    # Edit the kept records in place, column by column
+    mod_rows = rows & is_mod
+    put_column(matrix, mod_rows, 0, "ATOM  ")
+    for shift, column in ((16, 17), (8, 18), (0, 19)):
+        matrix[mod_rows, column] = (resn[mod_rows] >> shift) & 0xFF
+    se_rows = rows & is_mse
+    put_column(matrix, se_rows & (table["name"].astype("S2") == b"SE"), 12, " S")
+    put_column(matrix, se_rows & (lengths + newline > 75) & (table["element"] == b"SE"), 76, " S")
+    put_column(matrix, rows & (table["altloc"] == b"A"), 16, " ")
+    if options.removechain:
+        put_column(matrix, rows, 21, " ")
+    if options.keepzeroocc:
+        put_column(matrix, rows, 55, " 1.00")
+
+    # The chain written to the fasta is the one of the last record of the residue
+    last = np.zeros(nresidues, dtype=np.int64)
+    last[residue[rows]] = np.flatnonzero(rows)
+    residue_chain = matrix[last, 21]
+
+    pdb_text = renumbered_text(matrix[rows], lengths[rows], newline[rows], number[residue[rows]])
+    if renumbering is not None:
+        renumbering.extend(table["resnum"][np.flatnonzero(starts)[complete]].astype("U5").tolist())
+
+    fastaseq: Dict[str, str] = {}
+    accepted = np.flatnonzero(complete)
+    chains = residue_chain[accepted]
+    letters = residue_letter[accepted]
+    _, first = np.unique(chains, return_index=True)
+    for index in sorted(first):
+        chain = chains[index]
+        fastaseq[chr(chain)] = letters[chains == chain].tobytes().decode("latin-1")
+
+    return pdb_text, fastaseq, flags
+
+
+# Backbone geometry of consecutive residues (Å)
+C_N_MAX = 2.0  # a peptide bond is 1.33
+CA_CA_MAX = 4.2  # consecutive CA are 3.8 apart (2.9 for a cis peptide)
+CA_STEP = 3.8
+
+
+def chain_breaks(text: str, renumber: bool = False) -> Tuple[str, List[Dict[str, object]]]:
+    """
+    Find the chain breaks of cleaned PDB text, whose residues are numbered 1..n in order.
+
+    A break is a pair of consecutive residues of the same chain whose C(i)-N(i+1) distance
+    is over C_N_MAX or whose CA-CA distance is over CA_CA_MAX. Each break is reported as a
+    dict with the chain, the residue numbers on either side, both distances and the number
+    of residues estimated to be missing (the CA-CA distance in CA_STEP steps).
+
+    With renumber, the residues after each break are shifted by its missing residues, so
+    the numbering has a gap, and the renumbered text is returned instead of text.
+    Returns (text, breaks).
+    """
+    table, matrix, lengths, newline = read_atom_table(text, "", True)
+    if len(table) == 0:
+        return text, []
+
+    starts = np.ones(len(table), dtype=bool)
+    starts[1:] = (table["resnum"][1:] != table["resnum"][:-1]) | (table["chain"][1:] != table["chain"][:-1])
+    residue = np.cumsum(starts) - 1
+    nresidues = int(residue[-1]) + 1
+    number = np.arange(1, nresidues + 1)
+
+    # Numbers past 9999 widened their records; shift those back to the standard columns
+    _, lengths = restore_columns(matrix, lengths)
+
+    names = table["name"]
+    coords = np.ascontiguousarray(matrix[:, 30:54]).view("S8")
+    backbone = []
+    for atom in BACKBONE:
+        xyz = np.full((nresidues, 3), np.nan)
+        rows = np.flatnonzero(names == atom)
+        xyz[residue[rows]] = coords[rows].astype(float)
+        backbone.append(xyz)
+    n_atoms, ca_atoms, c_atoms = backbone
+
+    chain = table["chain"][starts]
+    same_chain = chain[1:] == chain[:-1]
+    c_n = np.linalg.norm(c_atoms[:-1] - n_atoms[1:], axis=1)
+    ca_ca = np.linalg.norm(ca_atoms[:-1] - ca_atoms[1:], axis=1)
+    broken = np.flatnonzero(same_chain & ((c_n > C_N_MAX) | (ca_ca > CA_CA_MAX)))
+    missing = np.maximum(1, np.ceil(ca_ca[broken] / CA_STEP).astype(int) - 1)
+
+    if renumber and len(broken):
+        shift = np.zeros(nresidues, dtype=np.int64)
+        shift[broken + 1] = missing
+        number = number + np.cumsum(shift)
+        text = renumbered_text(matrix, lengths, newline, number[residue])
+
+    breaks = [
+        {
+            "chain": chain[i].decode("latin-1"),
+            "after": int(number[i]),
+            "before": int(number[i + 1]),
+            "c_n": round(float(c_n[i]), 2),
+            "ca_ca": round(float(ca_ca[i]), 2),
+            "missing": int(m),
+        }
+        for i, m in zip(broken, missing)
+    ]
+    return text, breaks
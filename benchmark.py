@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+
+Synthetic-scale benchmarks for the parsers in this toolkit.
+
+Inputs are generated on the fly at every requested size:
+  - PDB files with several chains, alternate locations, MSE residues, insertion
+    codes, zero-occupancy backbone atoms and waters (clean_pdb.py)
+  - CLUSTAL .aln files with many sequences (parse_clustal_aln, and rank_templates
+    metrics of the first sequence against all the others)
+  - TOPCONS query.result.txt files holding several long sequences with their
+    topologies and Delta-G tables (parse_topcons_octopus_file + extract_tm_spans,
+    and extract_topcons_block)
+
+Every case runs in a freshly spawned process, so the reported peak RSS belongs to
+that case alone. For each case the best of --repeat runs is kept and reported with
+its throughput; for each benchmark the scaling exponent k of time ~ size^k is
+fitted over the sizes (k close to 1 means linear).
+
+The results are written as JSON (to stdout or --output) together with the machine,
+Python version and git revision, so runs can be compared over time. A summary table
+goes to stderr.
+
+Example:
+  $ python benchmark.py
+  $ python benchmark.py --only clean_pdb --pdb-atoms 1000,100000,1000000,5000000 -o bench.json
+  $ python benchmark.py --only clean_pdb --pdb-atoms 5000000 --parse-jobs 2,4,8   # core scaling
+  $ python benchmark.py --scale full --repeat 3 -o bench_$(date +%F).json
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+HERE = Path(__file__).resolve().parent
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+RESIDUES = ["ALA", "ARG", "ASN", "ASP", "CYS", "GLN", "GLU", "GLY", "HIS", "ILE",
+            "LEU", "LYS", "MET", "PHE", "PRO", "SER", "THR", "TRP", "TYR", "VAL"]
+BACKBONE = [(" N  ", "N"), (" CA ", "C"), (" C  ", "C"), (" O  ", "O"), (" CB ", "C")]
+CHAIN_IDS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+PREDICTORS = ["TOPCONS", "OCTOPUS", "Philius", "PolyPhobius", "SCAMPI", "SPOCTOPUS"]
+
+# Sizes swept by default (--scale quick) and with --scale full
+SCALES = {
+    "quick": {"pdb_atoms": [1000, 10000, 100000],
+              "aln_seqs": [10, 100, 1000],
+              "topcons_len": [1000, 10000, 100000]},
+    "full": {"pdb_atoms": [1000, 10000, 100000, 1000000, 5000000],
+             "aln_seqs": [10, 100, 1000, 10000, 100000],
+             "topcons_len": [1000, 10000, 100000, 1000000]},
+}
+
+
+# ---------------------------------------------------------------------------
+# Synthetic inputs
+# ---------------------------------------------------------------------------
+
+def _atom_line(serial: int, name: str, altloc: str, resn: str, chain: str, resnum: int,
+               icode: str, xyz: Tuple[float, float, float], occupancy: float, element: str,
+               record: str = "ATOM") -> str:
+    return "%-6s%5d %4s%1s%3s %1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f          %2s\n" % (
+        record, serial % 100000, name, altloc, resn, chain, resnum % 10000, icode,
+        xyz[0], xyz[1], xyz[2], occupancy, 20.0, element)
+
+
+def write_pdb(path: Path, n_atoms: int, seed: int = 0, chain_length: int = 500) -> int:
+    """
+    Write a PDB of about n_atoms atoms and return the exact number of atoms written.
+
+    Chains of chain_length residues; every 15th residue has A/B alternate locations,
+    every 20th is an MSE (HETATM, with an SE atom), every 25th carries an insertion
+    code, every 30th has a zero-occupancy CA and every 50th is followed by a water.
+    """
+    rng = random.Random(seed)
+    written = 0
+    residue = 0
+    with open(path, "w") as out:
+        out.write("HEADER    SYNTHETIC BENCHMARK STRUCTURE\n")
+        while written < n_atoms:
+            chain = CHAIN_IDS[(residue // chain_length) % len(CHAIN_IDS)]
+            index = residue % chain_length
+            resnum = index + 1
+            icode = " "
+            if index % 25 == 24:
+                resnum, icode = index, "A"  # same number as the previous residue
+            record, resn = "ATOM", rng.choice(RESIDUES)
+            atoms = list(BACKBONE)
+            if index % 20 == 19:
+                record, resn = "HETATM", "MSE"
+                atoms.append(("SE  ", "SE"))
+            altlocs = "AB" if index % 15 == 14 else " "
+
+            x, y, z = rng.uniform(-50, 50), rng.uniform(-50, 50), rng.uniform(-50, 50)
+            for altloc in altlocs:
+                for name, element in atoms:
+                    occupancy = 0.5 if altloc != " " else 1.0
+                    if name == " CA " and index % 30 == 29:
+                        occupancy = 0.0
+                    written += 1
+                    out.write(_atom_line(written, name, altloc, resn, chain, resnum, icode,
+                                         (x, y, z), occupancy, element, record))
+                    x += 1.2
+            if index % 50 == 49:
+                written += 1
+                out.write(_atom_line(written, " O  ", " ", "HOH", chain, 5000 + index, " ",
+                                     (x, y, z), 1.0, "O", "HETATM"))
+            residue += 1
+        out.write("END\n")
+    return written
+
+
+def write_clustal(path: Path, n_seqs: int, length: int = 300, seed: int = 0) -> int:
+    """
+    Write a CLUSTAL alignment of n_seqs sequences of `length` columns (about 10% gaps),
+    in blocks of 60 columns with a consensus line. Returns n_seqs.
+    """
+    rng = random.Random(seed)
+    alphabet = AMINO_ACIDS + "-" * 2
+    seqs = ["".join(rng.choices(alphabet, k=length)) for _ in range(n_seqs)]
+    ids = ["seq%06d|synthetic" % i for i in range(n_seqs)]
+    width = max(len(i) for i in ids) + 4
+    with open(path, "w") as out:
+        out.write("CLUSTAL O(1.2.4) multiple sequence alignment\n\n\n")
+        for start in range(0, length, 60):
+            for seq_id, seq in zip(ids, seqs):
+                out.write("%-*s%s\n" % (width, seq_id, seq[start:start + 60]))
+            block = min(60, length - start)
+            out.write(" " * width + "".join(rng.choice(" .:*") for _ in range(block)) + "\n\n")
+    return n_seqs
+
+
+def _topology(rng: random.Random, length: int) -> str:
+    parts = []
+    inside = True
+    while sum(map(len, parts)) < length:
+        parts.append(("i" if inside else "o") * rng.randint(5, 40))
+        parts.append("M" * rng.randint(17, 25))
+        inside = not inside
+    return "".join(parts)[:length]
+
+
+def write_topcons(path: Path, length: int, n_seqs: int = 10, seed: int = 0) -> int:
+    """
+    Write a TOPCONS2 query.result.txt with n_seqs sequences of `length` residues, each
+    with a topology per predictor and a Delta-G line per residue. Returns length.
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as out:
+        out.write("#" * 78 + "\nTOPCONS2 result file\nGenerated by benchmark.py\n" + "#" * 78 + "\n")
+        for number in range(1, n_seqs + 1):
+            seq = "".join(rng.choices(AMINO_ACIDS, k=length))
+            out.write("Sequence number: %d\n" % number)
+            out.write("Sequence name: sp|SYN%05d|SYNTH_%d Synthetic benchmark sequence\n" % (number, number))
+            out.write("Sequence length: %d aa.\nSequence:\n%s\n\n\n" % (length, seq))
+            for predictor in PREDICTORS:
+                out.write("%s predicted topology:\n%s\n\n\n" % (predictor, _topology(rng, length)))
+            out.write("Predicted Delta-G-values (kcal/mol) (left column=sequence position; "
+                      "right column=Delta-G)\n\n")
+            for position in range(1, length + 1):
+                out.write("%d %.3f\n" % (position, rng.uniform(-5, 10)))
+            out.write("\n" + "#" * 78 + "\n")
+    return length
+
+
+# ---------------------------------------------------------------------------
+# Measured code
+# ---------------------------------------------------------------------------
+
+def run_clean_pdb(path: Path, backend: str = "line", parse_jobs: Optional[int] = None) -> None:
+    import clean_pdb
+    options = clean_pdb.default_options()
+    options.backend = backend
+    options.parse_jobs = parse_jobs
+    with contextlib.redirect_stdout(io.StringIO()):
+        clean_pdb.clean_pdb(str(path), "ignorechain", options)
+
+
+def run_clustal(path: Path) -> None:
+    from clustal_to_grishin import parse_clustal_aln
+    parse_clustal_aln(path.read_text(encoding="utf-8"))
+
+
+def run_rank_templates(path: Path) -> None:
+    from clustal_to_grishin import parse_clustal_aln
+    from rank_templates import encode_alignment, rank_metrics
+    _, matrix = encode_alignment(parse_clustal_aln(path.read_text(encoding="utf-8")))
+    rank_metrics(matrix, 0)
+
+
+def run_octopus(path: Path) -> None:
+    from octopus2span import extract_tm_spans, parse_topcons_octopus_file
+    _, topo, _, _ = parse_topcons_octopus_file(path)
+    extract_tm_spans(topo)
+
+
+def run_topcons_block(path: Path) -> None:
+    from get_span_file import extract_topcons_block
+    extract_topcons_block(path.read_text(encoding="utf-8", errors="replace"))
+
+
+# name -> (generator, runner, size key in SCALES, unit of size, file suffix)
+BENCHMARKS: Dict[str, Tuple[Callable, Callable, str, str, str]] = {
+    "clean_pdb": (write_pdb, run_clean_pdb, "pdb_atoms", "atoms", ".pdb"),
+    "parse_clustal_aln": (write_clustal, run_clustal, "aln_seqs", "sequences", ".aln"),
+    "rank_templates": (write_clustal, run_rank_templates, "aln_seqs", "sequences", ".aln"),
+    "parse_topcons_octopus_file": (write_topcons, run_octopus, "topcons_len", "residues", ".txt"),
+    "extract_topcons_block": (write_topcons, run_topcons_block, "topcons_len", "residues", ".txt"),
+}
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident set size of this process, or None where it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # macOS reports bytes, Linux KiB
+
+
+def measure(name: str, path: str, repeat: int, kwargs: dict) -> dict:
+    """
+    Process pool entry point: run one case `repeat` times in an empty working directory
+    and return the timings and peak RSS of this (fresh) process.
+    """
+    sys.path.insert(0, str(HERE))
+    runner = BENCHMARKS[name][1]
+    workdir = tempfile.mkdtemp(prefix="bench_out_")
+    os.chdir(workdir)
+    try:
+        runner(Path(path), **kwargs)  # warm-up: imports, page cache
+        baseline = peak_rss_bytes()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            runner(Path(path), **kwargs)
+            times.append(time.perf_counter() - start)
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"times": times, "peak_rss": peak_rss_bytes(), "baseline_rss": baseline}
+
+
+def run_case(name: str, path: Path, repeat: int, kwargs: dict) -> dict:
+    """Run measure() in a freshly spawned process, so peak RSS is not shared between cases."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(measure, name, str(path), repeat, kwargs).result()
+
+
+def scaling_exponent(points: List[Tuple[int, float]]) -> Optional[float]:
+    """Least-squares slope of log(time) against log(size)."""
+    points = [(s, t) for s, t in points if s > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    xs = [math.log(s) for s, _ in points]
+    ys = [math.log(t) for _, t in points]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx == 0:
+        return None
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def parse_sizes(text: str) -> List[int]:
+    try:
+        sizes = [int(float(s)) for s in text.split(",") if s.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma separated sizes, got {text!r}")
+    if not sizes or min(sizes) < 1:
+        raise argparse.ArgumentTypeError(f"sizes must be positive, got {text!r}")
+    return sizes
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Benchmark the toolkit parsers on synthetic inputs.")
+    ap.add_argument("--scale", choices=sorted(SCALES), default="quick",
+                    help="Preset of sizes to sweep (default: %(default)s)")
+    ap.add_argument("--only", action="append", choices=sorted(BENCHMARKS),
+                    help="Run only this benchmark (may be repeated)")
+    ap.add_argument("--pdb-atoms", type=parse_sizes, help="Comma separated PDB sizes in atoms")
+    ap.add_argument("--aln-seqs", type=parse_sizes, help="Comma separated CLUSTAL sizes in sequences")
+    ap.add_argument("--aln-length", type=int, default=300, help="CLUSTAL alignment length (default: %(default)s)")
+    ap.add_argument("--topcons-len", type=parse_sizes, help="Comma separated TOPCONS sequence lengths")
+    ap.add_argument("--topcons-seqs", type=int, default=10,
+                    help="Sequences per TOPCONS result file (default: %(default)s)")
+    ap.add_argument("--backend", action="append", choices=["line", "numpy"],
+                    help="clean_pdb backend(s) to time (default: line)")
+    ap.add_argument("--parse-jobs", type=parse_sizes,
+                    help="Also time clean_pdb --parse-jobs with these comma separated worker counts")
+    ap.add_argument("--repeat", type=int, default=3, help="Timed runs per case; the best is kept (default: %(default)s)")
+    ap.add_argument("--seed", type=int, default=0, help="Seed of the synthetic inputs (default: %(default)s)")
+    ap.add_argument("--workdir", help="Where to write the inputs (default: a temporary directory)")
+    ap.add_argument("--keep", action="store_true", help="Keep the generated inputs")
+    ap.add_argument("-o", "--output", help="Write the JSON results here instead of stdout")
+    args = ap.parse_args()
+
+    if args.repeat < 1:
+        ap.error("--repeat must be at least 1")
+
+    sizes = dict(SCALES[args.scale])
+    for key in ("pdb_atoms", "aln_seqs", "topcons_len"):
+        if getattr(args, key) is not None:
+            sizes[key] = getattr(args, key)
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bench_in_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    try:
+        for name in args.only or BENCHMARKS:
+            generate, _, size_key, unit, suffix = BENCHMARKS[name]
+            variants = [{}]
+            if name == "clean_pdb":
+                variants = [{"backend": b} for b in (args.backend or ["line"])]
+                variants += [{"backend": "line", "parse_jobs": n} for n in args.parse_jobs or []]
+            for size in sizes[size_key]:
+                path = workdir / f"{size_key}_{size}{suffix}"
+                if not path.exists():
+                    if generate is write_clustal:
+                        generate(path, size, length=args.aln_length, seed=args.seed)
+                    elif generate is write_topcons:
+                        generate(path, size, n_seqs=args.topcons_seqs, seed=args.seed)
+                    else:
+                        generate(path, size, seed=args.seed)
+                nbytes = path.stat().st_size
+                for kwargs in variants:
+                    case = run_case(name, path, args.repeat, kwargs)
+                    best = min(case["times"])
+                    results.append({
+                        "benchmark": name,
+                        "params": kwargs,
+                        "size": size,
+                        "unit": unit,
+                        "bytes": nbytes,
+                        "seconds": best,
+                        "times": case["times"],
+                        "items_per_second": size / best if best > 0 else None,
+                        "mb_per_second": nbytes / 1e6 / best if best > 0 else None,
+                        "peak_rss_bytes": case["peak_rss"],
+                        "baseline_rss_bytes": case["baseline_rss"],
+                    })
+                    print(f"{name:<28} {json.dumps(kwargs) if kwargs else '':<22} {size:>9} {unit:<9} "
+                          f"{best:10.4f} s {size / best if best > 0 else float('inf'):12.0f} {unit}/s "
+                          f"{(case['peak_rss'] or 0) / 2**20:8.1f} MiB", file=sys.stderr)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    scaling = []
+    for name in args.only or BENCHMARKS:
+        for params in {json.dumps(r["params"], sort_keys=True) for r in results if r["benchmark"] == name}:
+            points = [(r["size"], r["seconds"]) for r in results
+                      if r["benchmark"] == name and json.dumps(r["params"], sort_keys=True) == params]
+            scaling.append({"benchmark": name, "params": json.loads(params),
+                            "sizes": [s for s, _ in points], "seconds": [t for _, t in points],
+                            "exponent": scaling_exponent(points)})
+
+    report = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "scale": args.scale,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "aln_length": args.aln_length,
+            "topcons_seqs": args.topcons_seqs,
+        },
+        "results": results,
+        "scaling": scaling,
+    }
+    text = json.dumps(report, indent=2) + "\n"
+    if args.output:
+        Path(args.output).write_text(text, encoding="utf-8")
+    else:
+        sys.stdout.write(text)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
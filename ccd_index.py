@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+ccd_index.py
+
+Modified-residue table for clean_pdb.py compiled from the wwPDB Chemical Component
+Dictionary (CCD).
+
+Building the index reads a local copy of components.cif (plain or gzipped) once, in a
+single pass that only looks at the _chem_comp items of each data block, and keeps every
+peptide-linking component whose mon_nstd_parent_comp_id is one of the 20 canonical amino
+acids. The mapping is written as a small binary file:
+
+  header  '<8sHHI32s': magic, format version, reserved, number of records, SHA-256 of
+          the components.cif it was built from
+  records count * 6 bytes: component id and parent id, 3 bytes each, space padded,
+          sorted by component id
+
+clean_pdb.py loads the index at start-up (a single read, no parsing of the CCD) and
+adds it over the built-in amino_acids.modres dict; if there is no index, or it cannot be
+read, the built-in dict is used on its own.
+
+The index is looked up in $CCD_INDEX, or ~/.cache/rosetta_cm_utils/ccd_modres.idx.
+
+Example:
+  $ wget https://files.wwpdb.org/pub/pdb/data/monomers/components.cif.gz
+  $ python ccd_index.py components.cif.gz
+  $ python ccd_index.py components.cif.gz -o /shared/ccd_modres.idx   # then export CCD_INDEX
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import hashlib
+import os
+import struct
+import sys
+from typing import Dict, Iterable, Optional, Tuple
+
+from amino_acids import longer_names, modres as builtin_modres
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser("~"), ".cache", "rosetta_cm_utils", "ccd_modres.idx")
+
+MAGIC = b"CCDMODRS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sHHI32s")
+RECORD = 6
+
+# Fields of the _chem_comp category we need
+FIELDS = ("id", "type", "mon_nstd_parent_comp_id")
+
+_loaded: Dict[str, Tuple[Dict[str, str], str]] = {}
+
+
+def index_path() -> str:
+    return os.environ.get("CCD_INDEX") or DEFAULT_INDEX
+
+
+def _unquote(value: str) -> str:
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return value
+
+
+def read_components(lines: Iterable[str]) -> Iterable[Dict[str, str]]:
+    """
+    Yield the _chem_comp items (FIELDS only) of every data block of components.cif.
+
+    Values of those items are single words or quoted strings on the line of their key (or
+    on the following line when the key is long); nothing else in the file is parsed.
+    """
+    record: Dict[str, str] = {}
+    pending = None
+    for line in lines:
+        if pending is not None:
+            if not line.startswith(";"):
+                record[pending] = _unquote(line)
+            pending = None
+            continue
+        if line.startswith("data_"):
+            if record:
+                yield record
+            record = {}
+        elif line.startswith("_chem_comp."):
+            key, _, value = line[11:].partition(" ")
+            if key in FIELDS:
+                value = value.strip()
+                if value:
+                    record[key] = _unquote(value)
+                else:
+                    pending = key
+    if record:
+        yield record
+
+
+def parent_mapping(components: Iterable[Dict[str, str]]) -> Dict[str, str]:
+    """
+    {component id: canonical parent} for peptide-linking components whose parent is one of
+    the 20 amino acids (or a comma separated list of one of them). Ids longer than the
+    three columns of a PDB residue name are skipped.
+    """
+    mapping: Dict[str, str] = {}
+    for comp in components:
+        comp_id = comp.get("id", "")
+        if not comp_id or len(comp_id) > 3 or "PEPTIDE" not in comp.get("type", "").upper():
+            continue
+        if comp_id in longer_names:
+            mapping[comp_id] = comp_id
+            continue
+        parents = {p.strip() for p in comp.get("mon_nstd_parent_comp_id", "?").split(",")}
+        if len(parents) == 1:
+            parent = parents.pop()
+            if parent in longer_names:
+                mapping[comp_id] = parent
+    return mapping
+
+
+def open_cif(path: str):
+    """Open components.cif for reading as text, gunzipping it if needed."""
+    with open(path, "rb") as fh:
+        gzipped = fh.read(2) == b"\x1f\x8b"
+    if gzipped:
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def file_sha256(path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def write_index(path: str, mapping: Dict[str, str], source_digest: bytes) -> None:
+    """Write mapping as a binary index (see the module docstring), atomically."""
+    body = b"".join(
+        ("%-3s%-3s" % (comp_id, mapping[comp_id])).encode("ascii") for comp_id in sorted(mapping)
+    )
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(mapping), source_digest))
+        fh.write(body)
+    os.replace(tmp, path)
+
+
+def read_index(path: str) -> Tuple[Dict[str, str], str]:
+    """Read a binary index: returns ({component id: parent}, hex SHA-256 of its source CCD)."""
+    with open(path, "rb") as fh:
+        data = fh.read()
+    if len(data) < HEADER.size:
+        raise ValueError("truncated index")
+    magic, version, _, count, digest = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("not a version %d CCD modres index" % FORMAT_VERSION)
+    body = data[HEADER.size:].decode("ascii")
+    if len(body) != count * RECORD:
+        raise ValueError("truncated index")
+    mapping = {
+        body[i : i + 3].rstrip(): body[i + 3 : i + 6].rstrip() for i in range(0, len(body), RECORD)
+    }
+    return mapping, digest.hex()
+
+
+def load_index(path: Optional[str] = None) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+    """
+    The index at path (default: index_path()) and its source digest, or (None, None) when
+    there is none. A broken index is reported on stderr and ignored. Loaded once per path.
+    """
+    path = path or index_path()
+    if path not in _loaded:
+        if not os.path.exists(path):
+            return None, None
+        try:
+            _loaded[path] = read_index(path)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            print(f"Ignoring CCD index {path}: {e}", file=sys.stderr)
+            return None, None
+    return _loaded[path]
+
+
+def modres_table(path: Optional[str] = None) -> Dict[str, str]:
+    """amino_acids.modres updated with the CCD index, or amino_acids.modres alone without one."""
+    mapping, _ = load_index(path)
+    if mapping is None:
+        return builtin_modres
+    table = dict(builtin_modres)
+    table.update(mapping)
+    return table
+
+
+def table_source(path: Optional[str] = None) -> str:
+    """Identifies the modres table in use: 'ccd:<sha256 of components.cif>' or 'builtin'."""
+    _, digest = load_index(path)
+    return "ccd:" + digest if digest else "builtin"
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(
+        description="Compile the modified-residue table of clean_pdb.py from a local components.cif."
+    )
+    ap.add_argument("components", help="components.cif or components.cif.gz from the wwPDB")
+    ap.add_argument("-o", "--output", default=index_path(),
+                    help="Index file to write (default: $CCD_INDEX or %(default)s)")
+    args = ap.parse_args()
+
+    try:
+        with open_cif(args.components) as fh:
+            mapping = parent_mapping(read_components(fh))
+    except OSError as e:
+        print(f"ERROR: cannot read {args.components}: {e}", file=sys.stderr)
+        return 1
+    if not mapping:
+        print(f"ERROR: no peptide components found in {args.components}", file=sys.stderr)
+        return 1
+
+    write_index(args.output, mapping, file_sha256(args.components))
+    new = sum(1 for comp_id in mapping if comp_id not in builtin_modres)
+    changed = sum(1 for comp_id in mapping
+                  if comp_id in builtin_modres and builtin_modres[comp_id] != mapping[comp_id])
+    print(f"Wrote {len(mapping)} residues to {args.output} "
+          f"({new} not in amino_acids.modres, {changed} with a different parent)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
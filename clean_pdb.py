@@ -5,8 +5,10 @@ It outputs both the cleaned PDB and a fasta file of the cleaned sequence.
 
 Required parameters are the name of the PDB you want to clean, and the chain ids of the chains you want.
 
-The PDB name may be specified with or without the .pdb file handle and may be provided as a gziped file.
+The PDB name may be specified with or without the .pdb file handle and may be provided as a gzip, bzip2 or xz
+compressed file (recognised by content, not by name). mmCIF/PDBx files (.cif) are read as well.
 If the PDB isn't found locally, the given 4 letter code will be fetched from the internet.
+A PDB name of '-' reads the PDB from standard input; --pdb-out/--fasta-out '-' write the results to standard output.
 
 Chain id: only the specified chains will be extracted. You may specify more than one: "AB" gets you chain A and B,
 and "C" gets you just chain C. Special notations are "nochain" to remove chain identiry from the output, and "ignorechain"
@@ -26,54 +28,128 @@ Version: Rosetta 3.14
 ## and leaves the 1st model among many NMR models
 
 from __future__ import print_function
+import bz2
+import copy
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import lzma
+import mmap
 import sys
 import os
+import re
+import time
 from sys import argv, stderr, stdout
 from os import popen, system
 from os.path import exists, basename
 from optparse import OptionParser
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 
 # Local package imports
 
 from amino_acids import longer_names
-from amino_acids import modres
+import ccd_index
+import pdb_cache
+
+# Modified residue -> canonical parent: amino_acids.modres, extended by the CCD index if built
+modres = ccd_index.modres_table()
+
+# Bump when the cleaned output changes, so --incremental rebuilds everything once
+__version__ = '3.14.1'
 
 # remote host for downloading pdbs
 remote_host = ''
 
-shit_stat_insres = False
-shit_stat_altpos = False
-shit_stat_modres = False
-shit_stat_misdns = False  # missing density!
+# Leading bytes of the compressed formats we read in-process, and the matching openers
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+]
+COMPRESSION_SUFFIXES = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
 
-fastaseq = {}
-pdbfile = ""
+# CIF value: a quoted string (closed by a quote followed by whitespace) or a bare word
+CIF_TOKEN = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""")
 
 
-def download_pdb(pdb_id, dest_dir):
+class CleanContext(object):
+    '''The state of cleaning one structure: where accepted residues go and what was seen.
+
+    Each clean_pdb() call (and each chain with --split-chains) gets its own context and
+    nothing is kept in module globals, so structures can be cleaned concurrently by the
+    threads of one process.
+    '''
+
+    def __init__(self, pdbfile=None, renumbering=False):
+        self.pdbfile = pdbfile  # where accepted residues are written (see open_output)
+        # input residue number (columns 23-27) of each residue written, for --archive
+        self.renumbering = [] if renumbering else None
+        self.fastaseq = {}  # chain -> sequence of the accepted residues
+        self.drop_counts = new_drop_counts()  # for the --report
+        self.insres = False
+        self.altpos = False
+        self.modres = False
+        self.misdns = False  # missing density!
+        # [21:27] of the first and last unknown residue dropped (see clean_lines_chunked)
+        self.first_unknown = None
+        self.last_unknown = None
+
+
+def download_pdb(pdb_id, dest_dir, fetcher=None):
+    '''Fetch pdb_id into dest_dir without caching it (see pdb_cache for the fetchers).'''
     # print("downloading %s" % ( pdb_id ))
-    url = 'http://www.rcsb.org/pdb/files/%s.pdb.gz' % (pdb_id.upper())
     dest = '%s/%s.pdb.gz' % (os.path.abspath(dest_dir), pdb_id)
-    wget_cmd = 'wget --quiet %s -O %s' % (url, dest)
-    print( wget_cmd )
-    if remote_host:
-        wget_cmd = 'ssh %s %s' % (remote_host, wget_cmd)
-
-    lines = popen(wget_cmd).readlines()
-    if (exists(dest)):
-        return(dest)
-    else:
-        print( "Error: didn't download file!" )
+    if fetcher is None:
+        fetcher = pdb_cache.make_fetcher(None, remote_host)
+    try:
+        data = fetcher(pdb_id)
+    except Exception as e:
+        print( "Error: didn't download file! (%s)" % e )
+        return None
+    handle = open(dest, 'wb')
+    handle.write(data)
+    handle.close()
+    return(dest)
+
+
+def fetch_pdb(pdb_id, options, files_to_unlink=None):
+    '''Find pdb_id in the local mirror or cache, downloading it into the cache if needed.
+
+    With the cache disabled (--pdb-cache none) the file is downloaded into the current
+    directory, and added to files_to_unlink to be deleted after cleaning, as before.
+    Returns (filename, stem).
+    '''
+    fetcher = pdb_cache.make_fetcher(options.fetch_url, remote_host)
+    cache = options.pdb_cache if options.pdb_cache not in ('', 'none') else None
+    try:
+        filename = pdb_cache.locate_pdb(pdb_id, options.pdb_mirror, cache, fetcher,
+                                        options.pdb_cache_size * 1024 * 1024)
+    except Exception as e:
+        raise IOError("didn't download %s: %s" % (pdb_id, e))
+    if filename is not None:
+        print( "Using %s from local mirror/cache at %s" % (pdb_id, filename), file=message_stream(options) )
+        return filename, pdb_id
+
+    filename = download_pdb(pdb_id, '.', fetcher)
+    if filename is None:
+        raise IOError("didn't download %s" % pdb_id)
+    if files_to_unlink is not None:
+        files_to_unlink.append(filename)
+    return filename, pdb_id
 
 
-def check_and_print_pdb(count, residue_buffer, residue_letter):
-    global pdbfile
+def check_and_print_pdb(ctx, count, residue_buffer, residue_letter):
   # Check that CA, N and C are present!def check_and_print_pdb( outid, residue_buffer )
     hasCA = False
     hasN = False
     hasC = False
+    backbone = set()
     for line in residue_buffer:
         atomname = line[12:16]
+        backbone.add(atomname)
         # Only add bb atoms if they have occupancy!
         occupancy = float(line[55:60])
         if atomname == " CA " and occupancy > 0.0:
@@ -90,70 +166,250 @@ def check_and_print_pdb(count, residue_buffer, residue_letter):
             newnum = '%4d ' % count
             line_edit = line[0:22] + newnum + line[27:]
             # write the residue line
-            pdbfile = pdbfile + line_edit
+            ctx.pdbfile.write(line_edit)
 
     # finally print residue letter into fasta strea
         chain = line[21]
+        if ctx.renumbering is not None:
+            ctx.renumbering.append(line[22:27])
         try:
-            fastaseq[chain] += residue_letter
+            ctx.fastaseq[chain] += residue_letter
         except KeyError:
-            fastaseq[chain] = residue_letter
+            ctx.fastaseq[chain] = residue_letter
     # count up residue number
         count = count + 1
         return True
+
+    # Tell residues without backbone atoms from those whose backbone has zero occupancy
+    if backbone.issuperset((" CA ", " N  ", " C  ")):
+        ctx.drop_counts['zero_occupancy'] += 1
+    else:
+        ctx.drop_counts['missing_backbone'] += 1
     return False
 
 def get_pdb_filename( name ):
     '''Tries various things to get the filename to use.
     Returns None if no acceptable file exists.'''
-    if( os.path.exists( name ) ):
-        return name
-    if( os.path.exists( name + '.pdb' ) ):
-        return name + '.pdb'
-    if( os.path.exists( name + '.pdb.gz' ) ):
-        return name + '.pdb.gz'
-    if( os.path.exists( name + '.pdb1.gz' ) ):
-        return name + '.pdb1.gz'
-    name = name.upper()
-    if( os.path.exists( name ) ):
-        return name
-    if( os.path.exists( name + '.pdb' ) ):
-        return name + '.pdb'
-    if( os.path.exists( name + '.pdb.gz' ) ):
-        return name + '.pdb.gz'
-    if( os.path.exists( name + '.pdb1.gz' ) ):
-        return name + '.pdb1.gz'
+    suffixes = [ '', '.pdb' ]
+    suffixes += [ '.pdb' + compressed for compressed in COMPRESSION_SUFFIXES ]
+    suffixes += [ '.pdb1' + compressed for compressed in COMPRESSION_SUFFIXES ]
+    suffixes += [ '.cif' ] + [ '.cif' + compressed for compressed in COMPRESSION_SUFFIXES ]
+    for candidate in ( name, name.upper() ):
+        for suffix in suffixes:
+            if( os.path.exists( candidate + suffix ) ):
+                return candidate + suffix
     # No acceptable file found
     return None
 
 
-def open_pdb( name ):
+def open_compressed( filename, mode='r' ):
+    '''Open a text file that may be gzip, bzip2 or xz compressed.
+
+    When reading, the format is recognised by its magic bytes, whatever the file is called.
+    When writing, it is chosen by the filename suffix (.gz, .bz2 or .xz; anything else is plain).
+    '''
+    if 'r' in mode:
+        with open(filename, 'rb') as handle:
+            magic = handle.read(6)
+        for prefix, opener in COMPRESSION_MAGIC:
+            if magic.startswith(prefix):
+                return opener(filename, 'rt')
+        return open(filename, 'r')
+
+    for suffix, opener in COMPRESSION_SUFFIXES.items():
+        if filename.endswith(suffix):
+            return opener(filename, 'wt')
+    return open(filename, mode)
+
+
+def split_cif_row( line ):
+    '''Split one line of a CIF loop into its values, unquoting quoted ones.'''
+    if "'" not in line and '"' not in line:
+        return line.split()
+    return [ single or double or bare
+             for single, double, bare in CIF_TOKEN.findall( line ) ]
+
+
+def fixed_decimals( value, width, decimals ):
+    '''Format a numeric CIF value like '%<width>.<decimals>f' does, without parsing it when possible.'''
+    if value[-decimals - 1:-decimals] == '.':
+        return value.rjust(width)
+    return '%*.*f' % (width, decimals, float(value))
+
+
+def mmcif_atom_lines( handle ):
+    '''Translate the _atom_site loop of an mmCIF/PDBx file into fixed-width PDB ATOM/HETATM lines.
+
+    The file is tokenized in a single pass and lines are generated one atom at a time, so the rest of
+    the cleaning (modres, altlocs, occupancy, renumbering) works unchanged. Author numbering and chain
+    ids are used when present, as in the PDB format files. An ENDMDL line is emitted between models.
+    Only the first character of multi-character chain ids fits the PDB chain column; residue names
+    longer than three characters cannot be represented and are skipped.
+    '''
+    try:
+        columns = []
+        lines = iter(handle)
+        for line in lines:
+            if line.startswith('loop_'):
+                columns = []
+            elif line.startswith('_atom_site.'):
+                columns.append(line.split()[0][len('_atom_site.'):])
+            elif columns and line.strip():
+                break
+        else:
+            return
+
+        # Columns missing from the file are served from defaults appended to every row
+        field = dict((name, i) for i, name in enumerate(columns))
+        defaults = []
+
+        def pick(default, *names):
+            for name in names:
+                if name in field:
+                    return field[name]
+            defaults.append(default)
+            return len(columns) + len(defaults) - 1
+
+        get_fields = itemgetter(
+            pick('ATOM', 'group_PDB'), pick('0', 'id'), pick('?', 'type_symbol'),
+            pick('?', 'auth_atom_id', 'label_atom_id'), pick('.', 'label_alt_id'),
+            pick('?', 'auth_comp_id', 'label_comp_id'), pick('?', 'auth_asym_id', 'label_asym_id'),
+            pick('0', 'auth_seq_id', 'label_seq_id'), pick('?', 'pdbx_PDB_ins_code'),
+            pick('0', 'Cartn_x'), pick('0', 'Cartn_y'), pick('0', 'Cartn_z'),
+            pick('?', 'occupancy'), pick('?', 'B_iso_or_equiv'), pick('?', 'pdbx_formal_charge'),
+            pick(None, 'pdbx_PDB_model_num') )
+        ncol = len(columns)
+        row = []
+        model = None
+
+        for line in itertools.chain([line], lines):
+            if line.startswith(('#', 'loop_', '_', 'data_')):
+                break
+            row.extend( split_cif_row( line ) )
+            if len(row) < ncol:
+                continue  # the row continues on the next line
+            values, row = row[:ncol] + defaults, row[ncol:]
+
+            (group, serial, element, name, alt, resn, chain, resnum, ins,
+             x, y, z, occ, bfac, charge, row_model) = get_fields(values)
+            if group not in ('ATOM', 'HETATM') or len(resn) > 3:
+                continue
+            if row_model != model:
+                if model is not None:
+                    yield 'ENDMDL\n'
+                model = row_model
+
+            if element in ('.', '?'):
+                element = ''
+            if len(name) < 4 and len(element) < 2 and not name[:1].isdigit():
+                name = ' ' + name
+            if occ in ('.', '?'):
+                occ = '1.00'
+            if bfac in ('.', '?'):
+                bfac = '0.00'
+            charge = 0 if charge in ('.', '?') else int(charge)
+
+            # Values already written with the PDB precision are copied as text, which avoids
+            # a float round trip for nearly every atom. Serial and residue numbers wrap around
+            # instead of breaking the fixed columns.
+            yield '%-6s%5d %-4s%1s%3s %1s%4d%1s   %8s%8s%8s%6s%6s          %2s%2s\n' % (
+                group, int(serial) % 100000, name, '' if alt in ('.', '?') else alt,
+                resn, chain[0], int(resnum) % 10000, '' if ins in ('.', '?') else ins,
+                fixed_decimals(x, 8, 3), fixed_decimals(y, 8, 3), fixed_decimals(z, 8, 3),
+                fixed_decimals(occ, 6, 2), fixed_decimals(bfac, 6, 2), element.upper(),
+                '%d%s' % (abs(charge), '+' if charge > 0 else '-') if charge else '' )
+    finally:
+        handle.close()
+
+
+def open_stdin():
+    '''Standard input as text lines, for the PDB name '-'.
+
+    Compressed and mmCIF input are recognised as in open_compressed() and open_pdb(), but
+    without rewinding: the lines read to tell mmCIF apart are put back in front of the rest.
+    '''
+    handle = sys.stdin
+    magic = sys.stdin.buffer.peek(6)[:6]
+    for prefix, opener in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            handle = opener(sys.stdin.buffer, 'rt')
+            break
+    head = []
+    for line in handle:
+        head.append(line)
+        if line.strip():
+            break
+
+    def lines():
+        for line in head:
+            yield line
+        for line in handle:
+            yield line
+
+    if head and head[-1].startswith('data_'):
+        return mmcif_atom_lines(lines())
+    return lines()
+
+
+def message_stream(options):
+    '''Where messages and status lines go: stderr when an output is written to stdout ('-').'''
+    if options is not None and '-' in (options.pdb_out, options.fasta_out):
+        return stderr
+    return sys.stdout
+
+
+def is_mmcif( handle ):
+    '''Peek at the first non-blank line of an open file to see whether it is mmCIF (then rewind).'''
+    for line in handle:
+        if line.strip():
+            break
+    else:
+        line = ''
+    handle.seek(0)
+    return line.startswith('data_')
+
+
+def open_pdb( name, options=None, files_to_unlink=None ):
     '''Open the PDB given in the filename (or equivalent).
-    If the file is not found, then try downloading it from the internet.
+    If the file is not found, then look it up in the local mirror/cache or download it
+    from the internet (see fetch_pdb and the --pdb-* options; files_to_unlink collects
+    downloads to delete afterwards).
+
+    mmCIF/PDBx files are recognised by content and read through mmcif_atom_lines().
 
-    Returns: (lines, filename_stem)
+    The name '-' reads standard input (see open_stdin), named options.stdin_name.
+
+    Returns: (lines, filename_stem), where lines is an open file (or generator) to be read line by line
     '''
+    if name == '-':
+        if options is None:
+            options = default_options()
+        print( "Reading PDB from standard input", file=message_stream(options) )
+        return open_stdin(), options.stdin_name
+
     filename = get_pdb_filename( name )
     if filename is not None:
-        print( "Found existing PDB file at", filename )
+        print( "Found existing PDB file at", filename, file=message_stream(options) )
+        stem = os.path.basename(filename)
     else:
-        print( "File for %s doesn't exist, downloading from internet." % (name) )
-        filename = download_pdb(name[0:4].upper(), '.')
-        global files_to_unlink
-        files_to_unlink.append(filename)
-
-    stem = os.path.basename(filename)
-    if stem[-3:] == '.gz':
-        stem = stem[:-3]
+        print( "File for %s doesn't exist, fetching it." % (name), file=message_stream(options) )
+        if options is None:
+            options = default_options()
+        filename, stem = fetch_pdb(name[0:4].upper(), options, files_to_unlink)
+
+    for suffix in COMPRESSION_SUFFIXES:
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    if stem[-4:] == '.cif':
+        stem = stem[:-4]
     if stem[-5:] == '.pdb1':
         stem = stem[:-5]
     if stem[-4:] == '.pdb':
         stem = stem[:-4]
 
-    if filename[-3:] == '.gz':
-        lines = popen('zcat '+filename, 'r').readlines()
-    else:
-        lines = open(filename, 'r').readlines()
+    lines = open_compressed(filename, 'r')
+    if is_mmcif(lines):
+        lines = mmcif_atom_lines(lines)
 
     return lines, stem
 
@@ -161,187 +417,1199 @@ def open_pdb( name ):
 # Program Start
 #############################################
 
-parser = OptionParser(usage="%prog [options] <pdb> <chain id>",
-        description=__doc__)
-parser.add_option("--nopdbout", action="store_true",
-        help="Don't output a PDB.")
-parser.add_option("--allchains", action="store_true",
-        help="Use all the chains from the input PDB.")
-parser.add_option("--removechain", action="store_true",
-        help="Remove chain information from output PDB.")
-parser.add_option("--keepzeroocc", action="store_true",
-        help="Keep zero occupancy atoms in output.")
+# File names picked up when --batch is given a directory
+BATCH_SUFFIXES = tuple(base + compressed for base in ('.pdb', '.pdb1', '.ent', '.cif')
+                       for compressed in ('',) + tuple(COMPRESSION_SUFFIXES))
+
+
+def build_parser():
+    parser = OptionParser(usage="%prog [options] <pdb> <chain id>\n"
+            "       %prog [options] --batch <dir|list> <chain id>",
+            description=__doc__)
+    parser.add_option("--nopdbout", action="store_true",
+            help="Don't output a PDB.")
+    parser.add_option("--allchains", action="store_true",
+            help="Use all the chains from the input PDB.")
+    parser.add_option("--removechain", action="store_true",
+            help="Remove chain information from output PDB.")
+    parser.add_option("--keepzeroocc", action="store_true",
+            help="Keep zero occupancy atoms in output.")
+    parser.add_option("--pdb-out", metavar="FILE",
+            help="Write the cleaned PDB to FILE instead of <stem>_<chain>.pdb; '-' writes it to "
+                 "stdout as it is produced (status lines then go to stderr).")
+    parser.add_option("--fasta-out", metavar="FILE",
+            help="Write the fasta sequence(s) to FILE instead of <stem>_<chain>.fasta; '-' writes "
+                 "them to stdout (after the PDB, with --pdb-out -).")
+    parser.add_option("--stdin-name", default="stdin", metavar="STEM",
+            help="Stem of the output files and fasta headers when the PDB is read from stdin "
+                 "('-') (default: %default).")
+    parser.add_option("--stream", action="store_true",
+            help="Write each accepted residue straight to the output PDB instead of "
+                 "building it in memory (memory use no longer grows with the structure).")
+    parser.add_option("--compress", type="choice", choices=["gz", "bz2", "xz"],
+            help="Write the output PDB compressed with gzip, bzip2 or xz.")
+    parser.add_option("--backend", type="choice", choices=["line", "numpy"], default="line",
+            help="Parsing backend: 'line' (default) filters line by line, 'numpy' parses the "
+                 "first model once into a column table and filters it with vectorized masks "
+                 "(faster on large structures, requires numpy; ignores --stream).")
+    parser.add_option("--parse-jobs", type="int", metavar="N",
+            help="Parse the first model of a large uncompressed PDB in byte ranges on N worker "
+                 "processes and stitch the results back in order (same output as reading it "
+                 "line by line; not with --batch, --models, --split-chains or --backend numpy).")
+    parser.add_option("--chain-breaks", type="choice", choices=["report", "annotate", "gap"],
+            help="Check the C-N and CA-CA distances of consecutive residues (requires numpy) and "
+                 "'report' the chain breaks (stderr and --report), also 'annotate' them as "
+                 "REMARK 999 lines, or leave a 'gap' in the numbering for the missing residues. "
+                 "Not available with --stream.")
+    parser.add_option("--archive", action="store_true",
+            help="Also write <stem>_<chain>.cln, a binary columnar copy of the cleaned structure "
+                 "(coordinates, atom/residue names, chains, renumbering map and sequence) that "
+                 "structure_archive.load() memory-maps (requires numpy).")
+    parser.add_option("--split-chains", action="store_true",
+            help="Write each requested chain (every chain with ignorechain/nochain) to its own "
+                 "<stem>_<chain>.pdb and fasta, reading the input once.")
+    parser.add_option("--model", type="int", metavar="N",
+            help="Clean only model N of an NMR/ensemble PDB (same as --models N).")
+    parser.add_option("--models", metavar="all|N|A-B",
+            help="Clean each selected model into its own <stem>_model<N> PDB and fasta, e.g. "
+                 "'all', '3', '1-20' or '1,4-6'. The file is read once and the models are "
+                 "cleaned in parallel.")
+    parser.add_option("--pdb-mirror", default=os.environ.get("PDB_MIRROR"), metavar="DIR",
+            help="Local wwPDB mirror (divided layout, ab/pdb1abc.ent.gz) searched before "
+                 "downloading (default: $PDB_MIRROR).")
+    parser.add_option("--pdb-cache", default=os.environ.get("PDB_CACHE", pdb_cache.DEFAULT_CACHE),
+            metavar="DIR",
+            help="Persistent cache for downloaded PDBs, or 'none' to download into the "
+                 "current directory and delete afterwards (default: $PDB_CACHE or %default).")
+    parser.add_option("--pdb-cache-size", type="int", default=pdb_cache.DEFAULT_MAX_MB, metavar="MB",
+            help="Size limit of the PDB cache; least recently used entries are evicted (default: %default).")
+    parser.add_option("--fetch-url", default=os.environ.get("PDB_FETCH_URL", pdb_cache.DEFAULT_URL),
+            metavar="URL|DIR",
+            help="Where to download missing PDBs from: a URL template with {ID}/{id}/{mid}, or "
+                 "a local directory (default: %default).")
+    parser.add_option("--batch", metavar="DIR|LIST",
+            help="Clean every PDB in a directory, or every PDB listed in a file "
+                 "(one '<pdb> [chain id]' per line), using the given chain id as default.")
+    parser.add_option("--report", metavar="FILE",
+            help="Write a JSON line per cleaned structure (per chain/model with --split-chains/"
+                 "--models) to FILE: residues kept and dropped by reason, chain lengths, parse "
+                 "and write times and atoms per second.")
+    parser.add_option("--incremental", metavar="MANIFEST",
+            help="Skip structures whose input, cleaning options, toolkit version and outputs "
+                 "are unchanged since they were recorded in the MANIFEST file (a JSON file, "
+                 "created if missing); the reason each structure is rebuilt goes to stderr.")
+    parser.add_option("-j", "--jobs", type="int", default=None,
+            help="Number of worker processes for --batch and --models (default: number of CPUs).")
+    return parser
+
+
+def default_options():
+    '''Return an options object with every command line option at its default.'''
+    options, _ = build_parser().parse_args([])
+    return options
+
+
+def resolve_chains(chains, options):
+    '''Apply the special chain designators ("ignorechain", "nochain", "_").
+
+    Returns (chainid, options), where options is a copy with allchains/removechain set as needed.
+    '''
+    options = copy.copy(options)
+    chains = chains.strip()
+    if chains == 'ignorechain':
+        options.allchains = True
+    if chains == 'nochain':
+        options.removechain = True
+        options.allchains = True
+
+    if chains != "ignorechain" and chains != "nochain":
+        chainid = chains.upper()
+    else:
+        chainid = chains
 
-options, args = parser.parse_args()
+    if chainid == '_':
+        chainid = ' '
 
-if 'nopdbout' in args:
-    options.nopdbout = True
-    args.remove('nopdbout')
+    return chainid, options
 
-if 'ignorechain' in args:
-    options.allchains = True
-    #Don't remove, because we're also using it as a chain designator
 
-if 'nochain' in args:
-    options.removechain = True
-    options.allchains = True
-    #Don't remove, because we're also using it as a chain designator
+def new_drop_counts():
+    '''Zeroed counters of the atoms read and of what was dropped, by reason (see --report).'''
+    return {'atoms': 0, 'missing_backbone': 0, 'zero_occupancy': 0, 'unknown_residue': 0,
+            'altloc_atoms': 0}
 
-if len(args) != 2:
-    parser.error("Must specify both the pdb and the chain id")
 
-files_to_unlink = []
+def flush_residue(ctx, count, residue_buffer, residue_letter):
+    '''Write the buffered residue (if any) as residue number count; returns the next number.'''
+    if residue_buffer != []:  # is there a residue in the buffer ?
+        if not check_and_print_pdb(ctx, count, residue_buffer, residue_letter):
+            # if unsuccessful
+            ctx.misdns = True
+        else:
+            count = count + 1
+    return count
 
-if args[1].strip() != "ignorechain" and args[1].strip() != "nochain":
-    chainid = args[1].upper()
-else:
-    chainid = args[1]
 
-lines, filename_stem = open_pdb( args[0] )
+def clean_lines(ctx, lines, chainid, options, switch_chain=None):
+    '''Filter and renumber the ATOM/HETATM lines of the first model, residue by residue.
 
-oldresnum = '   '
-count = 1
+    Accepted residues are written to ctx.pdbfile and their letters added to ctx.fastaseq as
+    they are completed, so only one residue is held in memory at a time.
+    Returns the next residue number (i.e. one more than the number of residues written).
 
-residue_buffer = []
-residue_letter = ''
+    With switch_chain (used by --split-chains), every chain keeps its own residue buffer and
+    numbering, and switch_chain(chain) is called whenever the chain changes; it returns the
+    context of that chain's output, used from then on (ctx may be None). Nothing is returned then.
+    '''
+    oldresnum = '   '
+    count = 1
 
-if chainid == '_':
-    chainid = ' '
+    residue_buffer = []
+    residue_letter = ''
 
-for line in lines:
+    chain_state = {}  # chain -> (oldresnum, count, residue_buffer, residue_letter)
+    current_chain = None
+    unknown_resnum = None
 
-    if line.startswith('ENDMDL'): break  # Only take the first NMR model
-    if len(line) > 21 and ( line[21] in chainid or options.allchains):
-        if line[0:4] != "ATOM" and line[0:6] != 'HETATM':
-            continue
+    for line in lines:
 
-        line_edit = line
-        resn = line[17:20]
-
-        # Is it a modified residue ?
-        # (Looking for modified residues in both ATOM and HETATM records is deliberate)
-        if resn in modres:
-            # if so replace it with its canonical equivalent !
-            orig_resn = resn
-            resn = modres[resn]
-            line_edit = 'ATOM  '+line[6:17]+ resn + line[20:]
-
-            if orig_resn == "MSE":
-                # don't count MSE as modified residues for flagging purposes (because they're so common)
-                # Also, fix up the selenium atom naming
-                if (line_edit[12:14] == 'SE'):
-                    line_edit = line_edit[0:12]+' S'+line_edit[14:]
-                if len(line_edit) > 75:
-                    if (line_edit[76:78] == 'SE'):
-                        line_edit = line_edit[0:76]+' S'+line_edit[78:]
-            else:
-                shit_stat_modres = True
+        if line.startswith('ENDMDL'): break  # Only take the first NMR model
+        if len(line) > 21 and ( line[21] in chainid or options.allchains):
+            if line[0:4] != "ATOM" and line[0:6] != 'HETATM':
+                continue
 
-        # Only process residues we know are valid.
-        if resn not in longer_names:
-            continue
+            if switch_chain is not None and line[21] != current_chain:
+                if current_chain is not None:
+                    chain_state[current_chain] = (oldresnum, count, residue_buffer, residue_letter)
+                current_chain = line[21]
+                ctx = switch_chain(current_chain)
+                oldresnum, count, residue_buffer, residue_letter = \
+                    chain_state.get(current_chain, ('   ', 1, [], ''))
+
+            ctx.drop_counts['atoms'] += 1
+
+            line_edit = line
+            resn = line[17:20]
+
+            # Is it a modified residue ?
+            # (Looking for modified residues in both ATOM and HETATM records is deliberate)
+            if resn in modres:
+                # if so replace it with its canonical equivalent !
+                orig_resn = resn
+                resn = modres[resn]
+                line_edit = 'ATOM  '+line[6:17]+ resn + line[20:]
+
+                if orig_resn == "MSE":
+                    # don't count MSE as modified residues for flagging purposes (because they're so common)
+                    # Also, fix up the selenium atom naming
+                    if (line_edit[12:14] == 'SE'):
+                        line_edit = line_edit[0:12]+' S'+line_edit[14:]
+                    if len(line_edit) > 75:
+                        if (line_edit[76:78] == 'SE'):
+                            line_edit = line_edit[0:76]+' S'+line_edit[78:]
+                else:
+                    ctx.modres = True
+
+            # Only process residues we know are valid.
+            if resn not in longer_names:
+                if line[21:27] != unknown_resnum:
+                    unknown_resnum = line[21:27]
+                    ctx.drop_counts['unknown_residue'] += 1
+                    if ctx.first_unknown is None:
+                        ctx.first_unknown = unknown_resnum
+                    ctx.last_unknown = unknown_resnum
+                continue
+
+            resnum = line_edit[22:27]
+
+            # Is this a new residue
+            if not resnum == oldresnum:
+                count = flush_residue(ctx, count, residue_buffer, residue_letter)
 
-        resnum = line_edit[22:27]
+                residue_buffer = []
+                residue_letter = longer_names[resn]
 
-        # Is this a new residue
-        if not resnum == oldresnum:
-            if residue_buffer != []:  # is there a residue in the buffer ?
-                if not check_and_print_pdb(count, residue_buffer, residue_letter):
-                    # if unsuccessful
-                    shit_stat_misdns = True
+            oldresnum = resnum
+
+            insres = line[26]
+            if insres != ' ':
+                ctx.insres = True
+
+            altpos = line[16]
+            if altpos != ' ':
+                ctx.altpos = True
+                if altpos == 'A':
+                    line_edit = line_edit[:16]+' '+line_edit[17:]
                 else:
-                    count = count + 1
+                    # Don't take the second and following alternate locations
+                    ctx.drop_counts['altloc_atoms'] += 1
+                    continue
 
-            residue_buffer = []
-            residue_letter = longer_names[resn]
+            if options.removechain:
+                line_edit = line_edit[:21]+' '+line_edit[22:]
 
-        oldresnum = resnum
+            if options.keepzeroocc:
+                line_edit = line_edit[:55] +" 1.00"+ line_edit[60:]
 
-        insres = line[26]
-        if insres != ' ':
-            shit_stat_insres = True
+            residue_buffer.append(line_edit)
 
-        altpos = line[16]
-        if altpos != ' ':
-            shit_stat_altpos = True
-            if altpos == 'A':
-                line_edit = line_edit[:16]+' '+line_edit[17:]
-            else:
-                # Don't take the second and following alternate locations
-                continue
 
-        if options.removechain:
-            line_edit = line_edit[:21]+' '+line_edit[22:]
+    if switch_chain is None:
+        return flush_residue(ctx, count, residue_buffer, residue_letter)
 
-        if options.keepzeroocc:
-            line_edit = line_edit[:55] +" 1.00"+ line_edit[60:]
+    # Every chain may still hold its last residue
+    if current_chain is not None:
+        chain_state[current_chain] = (oldresnum, count, residue_buffer, residue_letter)
+    for chain, (oldresnum, count, residue_buffer, residue_letter) in chain_state.items():
+        flush_residue(switch_chain(chain), count, residue_buffer, residue_letter)
 
-        residue_buffer.append(line_edit)
 
+# Byte ranges smaller than this are not worth a worker process (see --parse-jobs)
+CHUNK_MIN_BYTES = 1 << 20
+# Ranges per worker, so the renumbering of finished ranges overlaps the parsing of the rest
+CHUNKS_PER_JOB = 4
 
-if residue_buffer != []: # is there a residue in the buffer ?
-    if not check_and_print_pdb(count, residue_buffer, residue_letter):
-        # if unsuccessful
-        shit_stat_misdns = True
+
+def starts_residue(prev, line, chainid, options):
+    '''True if clean_lines() starts a new residue at line whatever was read before prev.
+
+    That is the case when prev and line are both atom records of selected chains and known
+    residues, with different residue numbers.
+    '''
+    for record in (prev, line):
+        if len(record) <= 21 or not ( record[21] in chainid or options.allchains):
+            return False
+        if record[0:4] != "ATOM" and record[0:6] != 'HETATM':
+            return False
+        if modres.get(record[17:20], record[17:20]) not in longer_names:
+            return False
+    return prev[22:27] != line[22:27]
+
+
+def chunk_offsets(filename, encoding, chunks, chainid, options):
+    '''Cut the first model of an uncompressed PDB file into about `chunks` byte ranges.
+
+    Each cut is the first residue start (see starts_residue) at or after an even share of
+    the model, and the last range ends before the first ENDMDL record. Returns the offsets
+    of the range starts followed by the end of the last range.
+    '''
+    with open(filename, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return [0, 0]
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        size = len(data)
+        if data[0:6] == b'ENDMDL':
+            size = 0
+        elif data.find(b'\nENDMDL') != -1:
+            size = data.find(b'\nENDMDL') + 1
+        chunks = max(1, min(chunks, size // CHUNK_MIN_BYTES))
+
+        offsets = [0]
+        for i in range(1, chunks):
+            start = data.find(b'\n', max(size * i // chunks, offsets[-1]) - 1, size) + 1
+            prev = None
+            while 0 < start < size:
+                end = data.find(b'\n', start, size) + 1 or size
+                line = data[start:end].decode(encoding, 'replace').replace('\r\n', '\n')
+                if prev is not None and starts_residue(prev, line, chainid, options):
+                    offsets.append(start)
+                    break
+                prev = line
+                start = end
+            else:
+                break  # no residue starts after this share of the model
+        offsets.append(size)
+        return offsets
+    finally:
+        data.close()
+
+
+def _chunk_worker(job):
+    '''Process pool entry point: clean the atom records in one byte range of a PDB file.
+
+    Returns (context with the cleaned text in pdbfile, number of residues written).
+    '''
+    filename, encoding, start, end, chainid, options = job
+    with open(filename, 'rb') as handle:
+        handle.seek(start)
+        data = handle.read(end - start)
+    ctx = CleanContext(io.StringIO(), options.archive)
+    count = clean_lines(ctx, io.TextIOWrapper(io.BytesIO(data), encoding), chainid, options)
+    ctx.pdbfile = ctx.pdbfile.getvalue()
+    return ctx, count - 1
+
+
+def renumber_lines(text, offset):
+    '''Add offset to the residue numbers check_and_print_pdb() wrote into text.'''
+    if offset == 0:
+        return text
+    renumbered = []
+    number = newnum = None
+    for line in text.splitlines(True):
+        end = line.index(' ', 26)  # '%4d ' widens past 9999
+        if line[22:end] != number:
+            number = line[22:end]
+            newnum = '%4d ' % (int(number) + offset)
+        renumbered.append(line[0:22] + newnum + line[end + 1:])
+    return "".join(renumbered)
+
+
+def clean_lines_chunked(ctx, lines, chainid, options):
+    '''Same as clean_lines(), parsing an uncompressed PDB file in byte ranges on worker processes.
+
+    The file is only cut where clean_lines() starts a new residue anyway (see chunk_offsets),
+    so every range can be cleaned on its own by one of options.parse_jobs processes. The
+    ranges are then written in order, renumbered after the residues of the ranges before them.
+    Compressed and mmCIF inputs, and files too small to share out, are read by clean_lines().
+    '''
+    raw = getattr(getattr(lines, 'buffer', None), 'raw', None)
+    if not isinstance(raw, io.FileIO) or not os.path.isfile(str(lines.name)):
+        return clean_lines(ctx, lines, chainid, options)
+    offsets = chunk_offsets(lines.name, lines.encoding, options.parse_jobs * CHUNKS_PER_JOB,
+                            chainid, options)
+    if len(offsets) <= 2:
+        return clean_lines(ctx, lines, chainid, options)
+
+    jobs = [(lines.name, lines.encoding, start, end, chainid, options)
+            for start, end in zip(offsets, offsets[1:])]
+    count = 1
+    last_unknown = None
+    with ProcessPoolExecutor(max_workers=options.parse_jobs) as executor:
+        for chunk, residues in executor.map(_chunk_worker, jobs):
+            ctx.pdbfile.write(renumber_lines(chunk.pdbfile, count - 1))
+            count += residues
+            for chain, seq in chunk.fastaseq.items():
+                ctx.fastaseq[chain] = ctx.fastaseq.get(chain, '') + seq
+            if ctx.renumbering is not None:
+                ctx.renumbering.extend(chunk.renumbering)
+            for reason, n in chunk.drop_counts.items():
+                ctx.drop_counts[reason] += n
+            # An unknown residue is counted once, even when a range starts with its other part
+            if chunk.first_unknown is not None and chunk.first_unknown == last_unknown:
+                ctx.drop_counts['unknown_residue'] -= 1
+            if chunk.last_unknown is not None:
+                last_unknown = chunk.last_unknown
+            ctx.insres = ctx.insres or chunk.insres
+            ctx.altpos = ctx.altpos or chunk.altpos
+            ctx.modres = ctx.modres or chunk.modres
+            ctx.misdns = ctx.misdns or chunk.misdns
+    return count
+
+
+def load_atom_table(feature="--backend numpy"):
+    '''Import the numpy backend, with a helpful message when numpy is missing.'''
+    try:
+        import atom_table
+    except ImportError:
+        raise ImportError("%s needs numpy; install it with 'pip install numpy'" % feature)
+    return atom_table
+
+
+def load_structure_archive():
+    '''Import structure_archive.py (for --archive), with a helpful message when numpy is missing.'''
+    try:
+        import structure_archive
+    except ImportError:
+        raise ImportError("--archive needs numpy; install it with 'pip install numpy'")
+    return structure_archive
+
+
+def check_chain_breaks(text, filename_stem, chainid, mode, removechain=False):
+    '''Find the chain breaks of the cleaned PDB text (see atom_table.chain_breaks).
+
+    mode is the --chain-breaks value: 'report' only reports them, 'gap' leaves a numbering
+    gap of the estimated missing residues at each break and 'annotate' adds a REMARK 999
+    line per break at the top. With removechain the chain column of the records is blanked
+    after the check. Returns (text to write, breaks).
+    '''
+    atom_table = load_atom_table("--chain-breaks")
+    text, breaks = atom_table.chain_breaks(text, renumber=(mode == 'gap'))
+    if removechain:
+        # The chain ids were kept for the check (see clean_structure); blank them now
+        text = "".join(line[:21] + ' ' + line[22:] if len(line) > 21 and line[0:4] in ("ATOM", "HETA")
+                       else line for line in text.splitlines(True))
+    if breaks:
+        print( "%s %s: %d chain break(s) after residue %s" % (filename_stem, chainid, len(breaks),
+               ", ".join("%s%d" % (b['chain'].strip(), b['after']) for b in breaks)), file=stderr )
+    if mode == 'annotate':
+        remarks = ["REMARK 999 CHAIN BREAK %s %4d %4d  C-N %7.2f  CA-CA %7.2f  MISSING %3d\n"
+                   % (b['chain'], b['after'], b['before'], b['c_n'], b['ca_ca'], b['missing'])
+                   for b in breaks]
+        text = "".join(remarks) + text
+    return text, breaks
+
+
+def clean_lines_numpy(ctx, lines, chainid, options):
+    '''Same as clean_lines(), using the vectorized backend in atom_table.py.'''
+    atom_table = load_atom_table()
+    text = atom_table.first_model_text(lines)
+    store_cleaned_text(ctx, *atom_table.clean_text(text, chainid, options, ctx.drop_counts, ctx.renumbering))
+
+
+def store_cleaned_text(ctx, cleaned, sequences, flags):
+    '''Write the (pdb text, fastaseq, flags) of the vectorized backend into ctx.'''
+    ctx.pdbfile.write(cleaned)
+    ctx.fastaseq.update(sequences)
+    ctx.altpos = flags['altpos']
+    ctx.insres = flags['insres']
+    ctx.modres = flags['modres']
+    ctx.misdns = flags['misdns']
+
+
+def clean_pdb(name, chains, options=None):
+    '''Clean one PDB and write the cleaned PDB and fasta file(s) into the current directory.
+
+    name and chains take the same values as on the command line; options is an optparse
+    Values object as returned by build_parser() (None means all defaults).
+
+    Returns a dict with the keys 'stem', 'chainid', 'nres', 'status' (the flag line the
+    script prints), 'fasta' (a list of (header, sequence) tuples, in output order),
+    'report' (the --report record: residues kept and dropped by reason, chain lengths, timings)
+    and 'outputs' (the files written).
+    With options.split_chains, returns a list of such dicts, one per chain.
+    Safe to call from several threads at once.
+    '''
+    if options is None:
+        options = default_options()
+    chainid, options = resolve_chains(chains, options)
+
+    files_to_unlink = []
+    lines, filename_stem = open_pdb( name, options, files_to_unlink )
+    try:
+        return clean_structure(lines, filename_stem, chainid, options)
+    finally:
+        for file in files_to_unlink:
+            os.unlink(file)
+
+
+def output_filename(filename_stem, chainid, options):
+    '''Name of the cleaned PDB written for chainid (options.pdb_out if given; '-' is stdout).'''
+    # outfile = string.lower(pdbname[0:4]) + chainid + pdbname[4:]
+    outfile = options.pdb_out or filename_stem + "_" + (chainid if chainid != ' ' else '_') + ".pdb"
+    if options.compress and outfile != '-' and not outfile.endswith("." + options.compress):
+        outfile += "." + options.compress
+    return outfile
+
+
+def open_stdout(compress=None):
+    '''A text stream to standard output, compressed if asked, that leaves stdout open when closed.'''
+    sys.stdout.flush()
+    if compress:
+        return COMPRESSION_SUFFIXES["." + compress](open(sys.stdout.fileno(), 'wb', buffering=0, closefd=False), 'wt')
+    return open(sys.stdout.fileno(), 'w', closefd=False)
+
+
+def open_pdb_output(outfile, options):
+    '''Open the cleaned PDB outfile for writing; '-' is standard output.'''
+    if outfile == '-':
+        return open_stdout(options.compress)
+    return open_compressed(outfile, 'w')
+
+
+def open_output(outfile, options):
+    '''Return the sink accepted residues are written to (see clean_structure).'''
+    if options.nopdbout and not (options.chain_breaks or options.archive):
+        return open(os.devnull, 'w')
+    elif options.nopdbout:
+        return io.StringIO()  # only for the chain break check and the archive
+    elif options.stream:
+        return open_pdb_output(outfile, options)
     else:
-        count = count + 1
+        return io.StringIO()
+
+
+def clean_structure(lines, filename_stem, chainid, options):
+    '''Clean already opened PDB lines (chainid as returned by resolve_chains) and write the outputs.
+
+    The lines are closed afterwards if they are a file. Returns the same dict as clean_pdb()
+    (a list of them, one per chain, with options.split_chains).
+    '''
+    if options.split_chains:
+        return clean_structure_split(lines, filename_stem, chainid, options)
+
+    outfile = output_filename(filename_stem, chainid, options)
+    streaming = options.stream and not options.nopdbout
+    ctx = CleanContext(open_output(outfile, options), options.archive)
+
+    # Without the chain ids the start of the next chain looks like a chain break, so with
+    # --chain-breaks they are kept while cleaning and blanked by check_chain_breaks()
+    clean_options = options
+    if options.chain_breaks and options.removechain:
+        clean_options = copy.copy(options)
+        clean_options.removechain = False
+
+    start = time.perf_counter()
+    try:
+        if options.backend == 'numpy':
+            clean_lines_numpy(ctx, lines, chainid, clean_options)
+        elif options.parse_jobs:
+            clean_lines_chunked(ctx, lines, chainid, clean_options)
+        else:
+            clean_lines(ctx, lines, chainid, clean_options)
+    except BaseException:
+        ctx.pdbfile.close()
+        if streaming and outfile != '-':
+            os.unlink(outfile)
+        raise
+    finally:
+        if hasattr(lines, 'close'):
+            lines.close()
+    if clean_options is not options and ctx.fastaseq:
+        # One sequence, as if the chain ids had been blanked while cleaning
+        ctx.fastaseq = {' ': "".join(ctx.fastaseq.values())}
+
+    return finish_structure(ctx, filename_stem, chainid, outfile, options,
+                            time.perf_counter() - start)
+
+
+def finish_structure(ctx, filename_stem, chainid, outfile, options, parse_seconds=0.0):
+    '''Write the cleaned PDB and fasta files from ctx.pdbfile/ctx.fastaseq and build the status line.
+
+    parse_seconds is the time spent reading and filtering the structure, for the report.
+    '''
+    streaming = options.stream and not options.nopdbout
+    start = time.perf_counter()
+
+    flag_altpos = "---"
+    if ctx.altpos:
+        flag_altpos = "ALT"
+    flag_insres = "---"
+    if ctx.insres:
+        flag_insres = "INS"
+    flag_modres = "---"
+    if ctx.modres:
+        flag_modres = "MOD"
+    flag_misdns = "---"
+    if ctx.misdns:
+        flag_misdns = "DNS"
+
+    nres = len("".join(list(ctx.fastaseq.values())))
+
+    flag_successful = "OK"
+    if nres <= 0:
+        flag_successful = "BAD"
+
+    if chainid == ' ':
+        chainid = '_'
+
+    status = " ".join([filename_stem, "".join(chainid), "%5d" % nres, flag_altpos,  flag_insres,  flag_modres,  flag_misdns, flag_successful])
+
+    fasta = []
+    outputs = []
+    breaks = None
+    if nres > 0:
+        if not streaming:
+            text = ctx.pdbfile.getvalue() if hasattr(ctx.pdbfile, 'getvalue') else ''
+            if options.chain_breaks:
+                text, breaks = check_chain_breaks(text, filename_stem, chainid, options.chain_breaks,
+                                                  options.removechain)
+        if streaming:
+            ctx.pdbfile.write("TER\n")
+            ctx.pdbfile.flush()  # before the fasta, which may go to the same stdout
+        elif not options.nopdbout:
+            outid = open_pdb_output(outfile, options)
+            outid.write(text)
+            outid.write("TER\n")
+            outid.close()
+        if not options.nopdbout and outfile != '-':
+            outputs.append(outfile)
+
+        if not options.allchains:
+            for chain in ctx.fastaseq:
+                fasta.append((filename_stem+"_"+"".join(chain), ctx.fastaseq[chain]))
+        else:
+            fasta.append((filename_stem+"_"+chainid, "".join(list(ctx.fastaseq.values()))))
+
+        if options.fasta_out:
+            # Every sequence into the one file (or stdout) asked for
+            handle = open_stdout() if options.fasta_out == '-' else open(options.fasta_out, 'w')
+            for header, seq in fasta:
+                handle.write('>'+header+'\n')
+                handle.write(seq)
+                handle.write('\n')
+            handle.close()
+            if options.fasta_out != '-':
+                outputs.append(options.fasta_out)
+        else:
+            for header, seq in fasta:
+                handle = open(header + ".fasta", 'w')
+                handle.write('>'+header+'\n')
+                handle.write(seq)
+                handle.write('\n')
+                handle.close()
+                outputs.append(header + ".fasta")
+
+    ctx.pdbfile.close()
+    if nres <= 0 and streaming and outfile != '-':
+        os.unlink(outfile)
+
+    if nres > 0 and options.archive:
+        if streaming:
+            with open_compressed(outfile) as handle:
+                text = handle.read()
+        structure_archive = load_structure_archive()
+        archive = structure_archive.archive_name(
+            outfile if outfile != '-' else filename_stem + "_" + chainid + ".pdb")
+        structure_archive.write_archive(archive, text, ctx.renumbering)
+        outputs.append(archive)
+
+    write_seconds = time.perf_counter() - start
+    total_seconds = parse_seconds + write_seconds
+    report = {'stem': filename_stem, 'chain': chainid, 'status': flag_successful,
+              'altpos': ctx.altpos, 'insres': ctx.insres,
+              'modres': ctx.modres, 'misdns': ctx.misdns,
+              'atoms': ctx.drop_counts['atoms'], 'residues_kept': nres,
+              'dropped': {reason: n for reason, n in ctx.drop_counts.items() if reason != 'atoms'},
+              'chains': {chain: len(seq) for chain, seq in ctx.fastaseq.items()},
+              'parse_seconds': round(parse_seconds, 6), 'write_seconds': round(write_seconds, 6),
+              'atoms_per_second': round(ctx.drop_counts['atoms'] / total_seconds, 1) if total_seconds > 0 else None}
+    if options.chain_breaks:
+        report['breaks'] = breaks
+
+    return {'stem': filename_stem, 'chainid': chainid, 'nres': nres,
+            'status': status, 'fasta': fasta, 'report': report, 'outputs': outputs}
+
+
+def clean_structure_split(lines, filename_stem, chainid, options):
+    '''Clean every selected chain into its own <stem>_<chain>.pdb and fasta in a single pass.
+
+    Each residue is routed to the output of its chain as it is read, so the outputs are the
+    same as cleaning the structure once per chain id, but the input is read only once.
+    With --allchains every chain found is written. Returns one clean_pdb() dict per chain.
+    '''
+    # Each chain is cleaned as if it had been asked for on its own
+    chain_options = copy.copy(options)
+    chain_options.allchains = False
+    streaming = options.stream and not options.nopdbout
+
+    outputs = {}  # chain -> (outfile, context)
+
+    def switch_chain(chain):
+        if chain not in outputs:
+            outfile = output_filename(filename_stem, chain, options)
+            outputs[chain] = (outfile, CleanContext(open_output(outfile, options), options.archive))
+        return outputs[chain][1]
+
+    start = time.perf_counter()
+    try:
+        if options.backend == 'numpy':
+            # The model is parsed into one atom table, whose rows are then cleaned chain by chain
+            atom_table = load_atom_table()
+            text = atom_table.first_model_text(lines)
+            for chain, records in atom_table.chain_tables(text, chainid, options.allchains).items():
+                ctx = switch_chain(chain)
+                store_cleaned_text(ctx, *atom_table.clean_table(*records, chain_options, ctx.drop_counts,
+                                                                ctx.renumbering))
+        else:
+            if not options.allchains:
+                for chain in chainid:  # requested chains get a (BAD) line even when absent
+                    switch_chain(chain)
+            clean_lines(None, lines, chainid, options, switch_chain)
+    except BaseException:
+        for outfile, ctx in outputs.values():
+            ctx.pdbfile.close()
+            if streaming:
+                os.unlink(outfile)
+        raise
+    finally:
+        if hasattr(lines, 'close'):
+            lines.close()
+
+    # The single pass is shared out between the chains by the number of atoms read
+    parse_seconds = time.perf_counter() - start
+    atoms = sum(ctx.drop_counts['atoms'] for _, ctx in outputs.values()) or 1
+
+    results = []
+    for chain, (outfile, ctx) in outputs.items():
+        # Name the fasta after the chain even when --removechain blanked it in the records
+        if ctx.fastaseq:
+            ctx.fastaseq = {chain: "".join(ctx.fastaseq.values())}
+        results.append(finish_structure(ctx, filename_stem, chain, outfile, chain_options,
+                                        parse_seconds * ctx.drop_counts['atoms'] / atoms))
+    return results
+
+
+def parse_model_spec(spec):
+    '''Parse a --models value: "all" (returns None), "N", "A-B" or a comma separated mix of those.'''
+    if spec.strip().lower() == 'all':
+        return None
+    wanted = set()
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError("invalid model range: %s" % part)
+        wanted.update(range(first, last + 1))
+    return wanted
+
+
+def split_models(lines, wanted=None):
+    '''Read PDB lines once and yield (model number, lines of that model) as each model ends.
+
+    Models are delimited by MODEL/ENDMDL records; a model without a MODEL record (or a file
+    without any) is numbered after the previous one. wanted is a set of model numbers, or None
+    for all of them; reading stops as soon as every wanted model has been seen.
+    '''
+    number = None
+    last = 0
+    block = []
+    remaining = set(wanted) if wanted is not None else None
+    for line in lines:
+        if line.startswith('MODEL'):
+            try:
+                number = int(line[10:14])
+            except ValueError:
+                number = last + 1
+            block = []  # anything before the MODEL record is header
+            continue
+        if line.startswith('ENDMDL'):
+            if number is None:
+                number = last + 1
+            if wanted is None or number in wanted:
+                yield number, block
+                if remaining is not None:
+                    remaining.discard(number)
+                    if not remaining:
+                        return
+            last = number
+            number = None
+            block = []
+            continue
+        if wanted is None or number is None or number in wanted:
+            block.append(line)
+
+    # Trailing atoms without an ENDMDL (e.g. a file with a single model)
+    if any(line.startswith(('ATOM', 'HETATM')) for line in block):
+        if number is None:
+            number = last + 1
+        if wanted is None or number in wanted:
+            yield number, block
+
+
+def _model_worker(job):
+    '''Process pool entry point: clean the lines of one model.'''
+    return clean_structure(*job)
+
+
+def clean_pdb_models(name, chains, options=None, workers=None):
+    '''Clean several models of an NMR/ensemble PDB, each into its own PDB and fasta file.
+
+    The file is read once and every model selected by options.models (see parse_model_spec)
+    is handed to a process pool of `workers` processes as soon as it has been read. Model N is
+    written with the stem "<stem>_model<N>". Returns the clean_pdb() dicts in model order
+    (with options.split_chains, the dicts of every chain of a model before the next model).
+    Requested models missing from the file are reported on stderr; ValueError is raised
+    when none of them is there.
+    '''
+    if options is None:
+        options = default_options()
+    chainid, options = resolve_chains(chains, options)
+    wanted = parse_model_spec(options.models or 'all')
+
+    files_to_unlink = []
+    lines, filename_stem = open_pdb( name, options, files_to_unlink )
+    try:
+        found = []  # model numbers read, to report the requested ones that are missing
+
+        def model_jobs():
+            for number, block in split_models(lines, wanted):
+                found.append(number)
+                yield (block, "%s_model%d" % (filename_stem, number), chainid, options)
+
+        models = model_jobs()
+        if workers == 1:
+            results = [_model_worker(job) for job in models]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_model_worker, job) for job in models]
+                results = [future.result() for future in futures]
+        if not found:
+            raise ValueError("none of the requested models (%s) found in %s" % (options.models or 'all', name))
+        missing = sorted(wanted - set(found)) if wanted is not None else []
+        if missing:
+            print( "Warning: models not found in %s: %s" % (name, ", ".join(map(str, missing))), file=stderr )
+        if options.split_chains:
+            results = list(itertools.chain.from_iterable(results))
+        return results
+    finally:
+        if hasattr(lines, 'close'):
+            lines.close()
+        for file in files_to_unlink:
+            os.unlink(file)
+
+
+def list_batch_inputs(batch, chains):
+    '''Expand the --batch argument into a list of (pdb, chain id) jobs.
+
+    A directory yields every file in it with a PDB-like suffix; anything else is read as
+    a list file with one "<pdb> [chain id]" per line (blank lines and #-comments ignored).
+    '''
+    jobs = []
+    if os.path.isdir(batch):
+        for entry in sorted(os.listdir(batch)):
+            path = os.path.join(batch, entry)
+            if entry.endswith(BATCH_SUFFIXES) and os.path.isfile(path):
+                jobs.append((path, chains))
+        return jobs
+
+    for line in open(batch, 'r'):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) > 1:
+            jobs.append((fields[0], fields[1]))
+        else:
+            jobs.append((fields[0], chains))
+    return jobs
+
+
+def _batch_worker(job):
+    '''Process pool entry point: clean one PDB, turning exceptions into an error message.'''
+    name, chains, options = job
+    try:
+        if options.models:
+            return name, clean_pdb_models(name, chains, options, workers=1), None
+        return name, clean_pdb(name, chains, options), None
+    except Exception as e:
+        return name, None, "%s: %s" % (type(e).__name__, e)
+
+
+def run_batch(jobs, options, workers=None):
+    '''Clean every (pdb, chain id) job on a process pool.
 
-flag_altpos = "---"
-if shit_stat_altpos:
-    flag_altpos = "ALT"
-flag_insres = "---"
-if shit_stat_insres:
-    flag_insres = "INS"
-flag_modres = "---"
-if shit_stat_modres:
-    flag_modres = "MOD"
-flag_misdns = "---"
-if shit_stat_misdns:
-    flag_misdns = "DNS"
+    Yields (pdb, result, error) in job order; result is the clean_pdb() dict, or None
+    with error set to a message if the structure could not be cleaned.
+    '''
+    tasks = [(name, chains, options) for name, chains in jobs]
+    if workers == 1:
+        for task in tasks:
+            yield _batch_worker(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for outcome in executor.map(_batch_worker, tasks, chunksize=4):
+            yield outcome
+
+
+def locate_input(name, options):
+    '''The local file clean_pdb() would read for name (a mirror or cache entry for PDB ids), or None.'''
+    filename = get_pdb_filename( name )
+    if filename is not None:
+        return filename
+    pdb_id = name[0:4].upper()
+    if options.pdb_mirror:
+        filename = pdb_cache.mirror_path(options.pdb_mirror, pdb_id)
+        if filename is not None:
+            return filename
+    if options.pdb_cache not in ('', 'none'):
+        return pdb_cache.cache_lookup(options.pdb_cache, pdb_id)
+    return None
 
-nres = len("".join(list(fastaseq.values())))
 
-flag_successful = "OK"
-if nres <= 0:
-    flag_successful = "BAD"
+def file_digest(filename, options):
+    '''SHA-256 of a file; cache objects are named after theirs, so they are not read.'''
+    if options.pdb_cache not in ('', 'none'):
+        objects = os.path.join(os.path.abspath(options.pdb_cache), 'objects')
+        if os.path.abspath(filename).startswith(objects + os.sep):
+            return os.path.basename(filename)
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stat(filename):
+    '''(size, mtime in ns) of a file, or None if it does not exist.'''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def manifest_options(chains, options):
+    '''The options that change what clean_pdb writes, as stored in the --incremental manifest.'''
+    return {'chains': chains, 'keepzeroocc': bool(options.keepzeroocc),
+            'removechain': bool(options.removechain), 'allchains': bool(options.allchains),
+            'nopdbout': bool(options.nopdbout), 'compress': options.compress,
+            'split_chains': bool(options.split_chains), 'models': options.models,
+            'modres': ccd_index.table_source(), 'chain_breaks': options.chain_breaks,
+            'archive': bool(options.archive), 'pdb_out': options.pdb_out,
+            'fasta_out': options.fasta_out}
+
+
+def load_manifest(path):
+    '''Read the --incremental manifest ({'version', 'entries'}); a missing or broken one is empty.'''
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as handle:
+                manifest = json.load(handle)
+            if isinstance(manifest.get('entries'), dict):
+                return manifest
+        except (OSError, ValueError, AttributeError) as e:
+            print( "Ignoring unreadable manifest %s: %s" % (path, e), file=stderr )
+    return {'version': __version__, 'entries': {}}
+
+
+def save_manifest(path, manifest):
+    '''Write the manifest atomically, so an interrupted run never leaves it half written.'''
+    manifest['version'] = __version__
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as handle:
+        json.dump(manifest, handle, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def manifest_key(name, chains, options):
+    '''Manifest key of a job: the input with its chains (and models), so that the same PDB
+    cleaned for different chains in one --batch list keeps one entry per job.'''
+    key = "%s %s" % (name, chains)
+    if options.models:
+        key += " models %s" % options.models
+    return key
+
+
+def stale_reason(entry, name, chains, options):
+    '''Why the structure must be cleaned again, or None if its outputs are up to date.
+
+    Only the sizes and modification times of the input and outputs are compared; the input
+    is hashed again only when its stat changed, and a matching hash refreshes the entry.
+    Output to standard output ('-' for --pdb-out/--fasta-out) is always written again.
+    '''
+    if entry is None:
+        return "new input"
+    if '-' in (options.pdb_out, options.fasta_out):
+        return "output goes to standard output"
+    if entry.get('error'):
+        return "failed last time"
+    if entry.get('version') != __version__:
+        return "toolkit version changed (%s -> %s)" % (entry.get('version'), __version__)
+    wanted = manifest_options(chains, options)
+    if entry.get('options') != wanted:
+        changed = sorted(key for key in wanted if entry.get('options', {}).get(key) != wanted[key])
+        return "options changed (%s)" % ", ".join(changed)
+
+    filename = locate_input(name, options)
+    if filename is None:
+        return "input not found locally"
+    stat = file_stat(filename)
+    if filename != entry.get('input') or stat != entry.get('stat'):
+        if file_digest(filename, options) != entry.get('sha256'):
+            return "input changed"
+        entry['input'], entry['stat'] = filename, stat
+
+    for output, stat in entry.get('outputs', []):
+        current = file_stat(output)
+        if current is None:
+            return "output missing: %s" % output
+        if current != stat:
+            return "output modified: %s" % output
+    return None
 
-if chainid == ' ':
-    chainid = '_'
 
-print( filename_stem, "".join(chainid), "%5d" % nres, flag_altpos,  flag_insres,  flag_modres,  flag_misdns, flag_successful )
+def manifest_entry(name, chains, options, results, error=None):
+    '''Manifest record of a structure just cleaned (results as a list of clean_pdb() dicts).'''
+    entry = {'version': __version__, 'options': manifest_options(chains, options)}
+    if error is not None:
+        entry['error'] = error
+        return entry
+    filename = locate_input(name, options)
+    if filename is not None:
+        entry.update(input=filename, stat=file_stat(filename), sha256=file_digest(filename, options))
+    entry['outputs'] = [[output, file_stat(output)] for result in results
+                        for output in result['outputs']]
+    entry['results'] = results
+    return entry
 
-if nres > 0:
-    if not options.nopdbout:
-        # outfile = string.lower(pdbname[0:4]) + chainid + pdbname[4:]
-        outfile = filename_stem + "_" + chainid + ".pdb"
 
-        outid = open(outfile, 'w')
-        outid.write(pdbfile)
-        outid.write("TER\n")
-        outid.close()
+def skipped_results(entry):
+    '''Copies of the clean_pdb() dicts stored for an up to date structure, their reports marked as skipped.'''
+    return [dict(result, report=dict(result['report'], skipped=True)) for result in entry['results']]
+
+
+def run_incremental(jobs, options, manifest=None, workers=None):
+    '''Like run_batch(), but skips structures the manifest says are up to date.
+
+    Yields (pdb, results, error) in job order, results being a list of clean_pdb() dicts.
+    The reason each structure is rebuilt is printed to stderr, and the manifest entries of
+    the rebuilt structures are replaced (the caller saves the manifest).
+    '''
+    keys = [manifest_key(name, chains, options) for name, chains in jobs]
+    stale = []
+    for (name, chains), key in zip(jobs, keys):
+        reason = None
+        if manifest is not None:
+            reason = stale_reason(manifest['entries'].get(key), name, chains, options)
+            if reason is not None:
+                print( "Rebuilding %s: %s" % (key, reason), file=stderr )
+        stale.append(manifest is None or reason is not None)
+
+    if manifest is not None:
+        print( "%d of %d structures up to date" % (stale.count(False), len(jobs)), file=stderr )
+
+    outcomes = run_batch([job for job, todo in zip(jobs, stale) if todo], options, workers)
+    for (name, chains), key, todo in zip(jobs, keys, stale):
+        if not todo:
+            yield name, skipped_results(manifest['entries'][key]), None
+            continue
+        _, result, error = next(outcomes)
+        if error is None and not (options.models or options.split_chains):
+            result = [result]
+        if manifest is not None:
+            manifest['entries'][key] = manifest_entry(name, chains, options, result, error)
+        yield name, result, error
+
+
+def open_report(options):
+    '''Open the --report file, or return None when no report was asked for.'''
+    if not options.report:
+        return None
+    return open(options.report, 'w')
+
+
+def write_report(report, name, results, error=None):
+    '''Append the report records of one input (or a record of its error) as JSON lines.'''
+    if report is None:
+        return
+    if error is not None:
+        report.write(json.dumps({'input': name, 'status': 'ERROR', 'error': error}) + "\n")
+    for result in results:
+        record = {'input': name}
+        record.update(result['report'])
+        report.write(json.dumps(record) + "\n")
+
+
+def main(argv=None):
+    parser = build_parser()
+    options, args = parser.parse_args(argv)
+
+    if 'nopdbout' in args:
+        options.nopdbout = True
+        args.remove('nopdbout')
+
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if options.parse_jobs is not None:
+        if options.parse_jobs < 1:
+            parser.error("--parse-jobs must be at least 1")
+        if options.batch or options.model is not None or options.models or options.split_chains:
+            parser.error("--parse-jobs cannot be combined with --batch, --models or --split-chains")
+        if options.backend != 'line':
+            parser.error("--parse-jobs only applies to the line backend")
+    if options.pdb_out or options.fasta_out:
+        if options.batch or options.model is not None or options.models or options.split_chains:
+            parser.error("--pdb-out and --fasta-out write a single structure; they cannot be combined "
+                         "with --batch, --models or --split-chains")
+    if options.pdb_out == '-':
+        if options.archive and options.stream:
+            parser.error("--archive reads the streamed PDB back; it cannot be used with --stream and --pdb-out -")
+        # Write residues to stdout as they are accepted, unless the whole structure is needed
+        options.stream = not (options.chain_breaks or options.archive)
+    if options.incremental and '-' in args:
+        parser.error("--incremental needs a PDB file, not standard input")
+    if options.chain_breaks and options.stream:
+        parser.error("--chain-breaks needs the cleaned structure in memory; it cannot be used with --stream")
+    if options.model is not None:
+        options.models = str(options.model)
+    if options.models:
+        try:
+            parse_model_spec(options.models)
+        except ValueError:
+            parser.error("Invalid model selection: %s" % options.models)
+
+    if options.batch:
+        if len(args) != 1:
+            parser.error("Must specify the chain id to use with --batch")
+
+        jobs = list_batch_inputs(options.batch, args[0])
+        manifest = load_manifest(options.incremental) if options.incremental else None
+        failed = 0
+        report = open_report(options)
+        try:
+            for name, result, error in run_incremental(jobs, options, manifest, options.jobs):
+                if error is not None:
+                    failed += 1
+                    print( "Error cleaning %s: %s" % (name, error), file=stderr )
+                    write_report(report, name, [], error)
+                    continue
+                for structure_result in result:
+                    print( structure_result['status'] )
+                write_report(report, name, result)
+        finally:
+            if report is not None:
+                report.close()
+            if manifest is not None:
+                save_manifest(options.incremental, manifest)
+        return 1 if failed else 0
+
+    if len(args) != 2:
+        parser.error("Must specify both the pdb and the chain id")
+
+    manifest = load_manifest(options.incremental) if options.incremental else None
+    key = manifest_key(args[0], args[1], options)
+    reason = "no manifest"
+    if manifest is not None:
+        entry = manifest['entries'].get(key)
+        reason = stale_reason(entry, args[0], args[1], options)
+    if reason is None:
+        print( "%s is up to date, not cleaned again" % key, file=stderr )
+        results = skipped_results(entry)
+    else:
+        if manifest is not None:
+            print( "Rebuilding %s: %s" % (key, reason), file=stderr )
+        try:
+            if options.models:
+                results = clean_pdb_models(args[0], args[1], options, options.jobs)
+            elif options.split_chains:
+                results = clean_pdb(args[0], args[1], options)
+            else:
+                results = [clean_pdb(args[0], args[1], options)]
+        except BrokenPipeError:
+            # The reader of stdout went away; ends the run quietly, see __main__
+            raise
+        except (IOError, OSError, ValueError) as e:
+            # e.g. a PDB id found neither in the mirror or cache nor for download, or
+            # a --models selection matching no model of the file
+            print( "ERROR: %s: %s" % (args[0], e), file=stderr )
+            if manifest is not None:
+                manifest['entries'][key] = manifest_entry(args[0], args[1], options, [], str(e))
+                save_manifest(options.incremental, manifest)
+            return 1
+        if manifest is not None:
+            manifest['entries'][key] = manifest_entry(args[0], args[1], options, results)
+    if manifest is not None:
+        save_manifest(options.incremental, manifest)
+
+    report = open_report(options)
+    write_report(report, args[0], results)
+    if report is not None:
+        report.close()
+
+    if message_stream(options) is stderr:
+        # stdout carries the cleaned PDB and/or fasta
+        for result in results:
+            print( result['status'], file=stderr )
+        return 0
 
     fastaid = stdout
-    if not options.allchains:
-        for chain in fastaseq:
-            fastaid.write('>'+filename_stem+"_"+chain+'\n')
-            fastaid.write(fastaseq[chain])
+    for result in results:
+        print( result['status'] )
+
+        for header, seq in result['fasta']:
+            fastaid.write('>'+header+'\n')
+            fastaid.write(seq)
             fastaid.write('\n')
-            handle = open(filename_stem+"_"+"".join(chain) + ".fasta", 'w')
-            handle.write('>'+filename_stem+"_"+"".join(chain)+'\n')
-            handle.write(fastaseq[chain])
-            handle.write('\n')
-            handle.close()
-    else:
-        fastaseq = ["".join(list(fastaseq.values()))]
-        fastaid.write('>'+filename_stem+"_"+chainid+'\n')
-        fastaid.writelines(fastaseq)
-        fastaid.write('\n')
-        handle = open(filename_stem+"_"+chainid + ".fasta", 'w')
-        handle.write('>'+filename_stem+"_"+chainid+'\n')
-        handle.writelines(fastaseq)
-        handle.write('\n')
-        handle.close()
 
-if len(files_to_unlink) > 0:
-    for file in files_to_unlink:
-        os.unlink(file)
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        # The reader of our stdout went away (e.g. "| head"); don't fail again on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -3,7 +3,9 @@
 clustal_to_grishin.py
 
 Convert a CLUSTAL/Clustal-Omega .aln multiple-sequence alignment into a Rosetta
-Grishin (.grishin) *pairwise* alignment.
+Grishin (.grishin) *pairwise* alignment. Aligned FASTA, A3M (HHblits) and Stockholm
+(HMMER) alignments are read as well; the format is guessed from the start of the file
+(see sniff_format()) unless given with --format.
 
 Grishin format (typical Rosetta usage):
   ## <TARGET_NAME> <TEMPLATE_NAME>.pdb
@@ -14,8 +16,21 @@ Grishin format (typical Rosetta usage):
 
 Notes:
 - CLUSTAL .aln often contains multiple sequences; Grishin is usually pairwise.
-  You must choose exactly two sequence IDs from the alignment.
-- Sequence IDs must match the first column in the .aln blocks (exactly).
+  Each Grishin file pairs the target with one template. Several templates
+  (repeated --template-id, or --all-templates) are written in one read of the .aln,
+  one <target-name>_<template>.grishin per template in --out-dir (characters other
+  than letters, digits, '.', '_' and '-', such as the '/' of Stockholm ids like
+  Q1/1-10, are written as '_' in the file name).
+- --strip-gap-columns drops the columns that are gaps in both sequences of a pair
+  (columns that were only there for the other sequences of the alignment).
+- Sequence IDs must match the first column in the .aln blocks (exactly), or the
+  first word of the FASTA/A3M headers.
+- A3M insert states (lowercase residues and '.') are dropped, leaving the columns
+  of the query; aligned FASTA and Stockholm sequences are used as they are.
+- The alignment is read line by line and only the requested sequences are kept, so
+  alignments with tens of thousands of sequences need no more memory than those.
+  A CLUSTAL .aln indexed with aln_index.py (<aln>.idx) is not read at all: the ids
+  come from the index and the sequences from a few slices of the file.
 
 Usage:
 python new_ch_convert.py <alignment_file.aln> <target_seq.fasta> \
@@ -29,6 +44,8 @@ Example:
 python new_ch_convert.py examples/convert_aln_to_grishin/COX3gg_COX3hs.aln  \
     --target-id "COX3gg"   --template-id "COX3hs"   --target-name COX3gg   \
     --template-name COX3hs   --out COX3gg_COX3hs.grishin
+python clustal_to_grishin.py COX3_family.aln --target-id COX3gg --all-templates \
+    --out-dir grishin/ --strip-gap-columns
     
     
 Created by:
@@ -54,13 +71,24 @@ Repository/URL:    https://github.com/csimong/rosetta_cm_utils
 from __future__ import annotations
 
 import argparse
+import string
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Collection, Iterable, Iterator, Optional
 
+import aln_index
 
-def parse_clustal_aln(text: str) -> dict[str, str]:
+# Gap characters of aligned sequences
+GAPS = frozenset("-.")
+# Characters kept as they are when a sequence id becomes part of a file name
+FILENAME_CHARS = frozenset(string.ascii_letters + string.digits + "._-")
+
+
+def clustal_fragments(lines: Iterable[str]) -> Iterator[tuple[str, str]]:
     """
-    Parse a CLUSTAL-like .aln file into a dict: {sequence_id: full_aligned_sequence}.
+    Yield (sequence_id, fragment) for every alignment block line of a CLUSTAL-like .aln,
+    in file order, reading the lines one at a time.
 
     Rules:
     - Skip header lines starting with 'CLUSTAL' (or 'MUSCLE', for compatibility).
@@ -69,11 +97,7 @@ def parse_clustal_aln(text: str) -> dict[str, str]:
     - For each alignment block line: <id> <fragment> [optional stuff...]
       Only the first two fields are used.
     """
-    seqs: dict[str, str] = {}
-
-    for raw in text.splitlines():
-        line = raw.rstrip("\n")
-
+    for line in lines:
         if not line.strip():
             continue
 
@@ -84,7 +108,7 @@ def parse_clustal_aln(text: str) -> dict[str, str]:
         if line[0].isspace():
             continue
 
-        parts = line.strip().split()
+        parts = line.split(None, 2)
         if len(parts) < 2:
             continue
 
@@ -94,9 +118,149 @@ def parse_clustal_aln(text: str) -> dict[str, str]:
         if fragment.isdigit():
             continue
 
-        seqs[seq_id] = seqs.get(seq_id, "") + fragment
+        yield seq_id, fragment
+
+
+def fasta_fragments(lines: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """
+    Yield (sequence_id, fragment) for every sequence line of an aligned FASTA (or A2M) file.
+
+    Rules:
+    - The id is the first word after '>'; the rest of the header is ignored.
+    - Lines starting with '#' (e.g. the '#A3M#' marker) and empty lines are skipped.
+    - Sequence lines are kept as they are: every sequence has one character per column.
+    """
+    seq_id = None
+    for line in lines:
+        if line.startswith(">"):
+            fields = line[1:].split(None, 1)
+            seq_id = fields[0] if fields else ""
+            continue
+        if seq_id is None or line.startswith("#"):
+            continue
+        fragment = line.strip()
+        if fragment:
+            yield seq_id, fragment
 
-    return seqs
+
+# A3M insert states: lowercase residues and '.' are not columns of the alignment
+_A3M_INSERTS = str.maketrans("", "", string.ascii_lowercase + ".")
+
+
+def a3m_fragments(lines: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """
+    Yield (sequence_id, fragment) for every sequence line of an A3M file (HHblits/HHsearch).
+
+    As fasta_fragments(), with the insert states (lowercase residues and '.') removed:
+    what is left are the match columns, one per residue of the query, so that every
+    sequence comes out with the same length as in the other formats.
+    """
+    for seq_id, fragment in fasta_fragments(lines):
+        yield seq_id, fragment.translate(_A3M_INSERTS)
+
+
+def stockholm_fragments(lines: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """
+    Yield (sequence_id, fragment) for every sequence line of a Stockholm file (HMMER, Pfam).
+
+    Rules:
+    - Skip the '# STOCKHOLM' header, '#=GF/GS/GR/GC' markup and empty lines.
+    - Sequence lines are <id> <fragment>; blocks may repeat the ids (interleaved).
+    - Only the first alignment of the file is read: reading stops at '//'.
+    """
+    for line in lines:
+        if line.startswith("//"):
+            return
+        if line.startswith("#") or not line.strip():
+            continue
+        parts = line.split()
+        if len(parts) >= 2:
+            yield parts[0], parts[1]
+
+
+# Alignment formats understood by the converter and their fragment readers
+FORMATS = {
+    "clustal": clustal_fragments,
+    "fasta": fasta_fragments,
+    "a3m": a3m_fragments,
+    "stockholm": stockholm_fragments,
+}
+
+# Bytes of the start of the file looked at by sniff_format()
+SNIFF_BYTES = 1 << 16
+
+
+def sniff_format(path: Path) -> str:
+    """
+    Guess the format of an alignment file from its first bytes (and the .a3m suffix).
+
+    Rules:
+    - '# STOCKHOLM' header -> stockholm
+    - '#A3M#' marker or an .a3m suffix -> a3m
+    - FASTA records ('>') -> a3m when the complete records seen have different lengths
+      and lowercase residues, fasta otherwise
+    - anything else -> clustal (with or without its CLUSTAL/MUSCLE header)
+    """
+    with path.open(errors="replace") as fh:
+        head = fh.read(SNIFF_BYTES)
+    first = head.lstrip().split("\n", 1)[0].strip()
+    if first.startswith("# STOCKHOLM"):
+        return "stockholm"
+    if first.startswith("#A3M#") or path.suffix.lower() == ".a3m":
+        return "a3m"
+    if first.startswith(">"):
+        # The last record of the head may be cut short
+        complete = head if len(head) < SNIFF_BYTES else head[: max(head.rfind("\n>"), 0)]
+        lengths = set()
+        lowercase = False
+        for _, seq in read_alignment(complete.splitlines(), "fasta").items():
+            lengths.add(len(seq))
+            lowercase = lowercase or seq != seq.upper()
+        return "a3m" if len(lengths) > 1 and lowercase else "fasta"
+    return "clustal"
+
+
+def read_alignment(
+    lines: Iterable[str], fmt: str = "clustal", keep: Optional[Collection[str]] = None
+) -> dict[str, str]:
+    """
+    Read an alignment in format fmt (a key of FORMATS) into a dict:
+    {sequence_id: full_aligned_sequence}, in order of first appearance.
+
+    The fragments of each sequence are collected in a list and joined once at the end, so
+    reading is linear in the size of the file. With keep, only those sequence ids are
+    stored and memory scales with them rather than with the whole alignment.
+    """
+    fragments: dict[str, list[str]] = {}
+    for seq_id, fragment in FORMATS[fmt](lines):
+        if keep is not None and seq_id not in keep:
+            continue
+        fragments.setdefault(seq_id, []).append(fragment)
+    return {seq_id: "".join(parts) for seq_id, parts in fragments.items()}
+
+
+def alignment_ids(lines: Iterable[str], fmt: str = "clustal") -> list[str]:
+    """Sequence ids of an alignment in order of appearance, without keeping the sequences."""
+    return list(dict.fromkeys(seq_id for seq_id, _ in FORMATS[fmt](lines)))
+
+
+def read_clustal_aln(lines: Iterable[str], keep: Optional[Collection[str]] = None) -> dict[str, str]:
+    """Read a CLUSTAL-like .aln block by block: read_alignment() for the clustal format."""
+    return read_alignment(lines, "clustal", keep)
+
+
+def clustal_ids(lines: Iterable[str]) -> list[str]:
+    """Sequence ids of a CLUSTAL-like .aln in order of appearance, without keeping the sequences."""
+    return alignment_ids(lines, "clustal")
+
+
+def parse_clustal_aln(text: str, keep: Optional[Collection[str]] = None) -> dict[str, str]:
+    """
+    Parse the text of a CLUSTAL-like .aln file into a dict: {sequence_id: full_aligned_sequence}.
+
+    See clustal_fragments() for the rules and read_alignment() for keep.
+    """
+    return read_clustal_aln(text.splitlines(), keep)
 
 
 def build_grishin(
@@ -119,14 +283,69 @@ def build_grishin(
     )
 
 
+def strip_gap_columns(target_aln: str, template_aln: str) -> tuple[str, str]:
+    """Drop the columns that are a gap ('-' or '.') in both aligned sequences."""
+    kept = [(a, b) for a, b in zip(target_aln, template_aln) if a not in GAPS or b not in GAPS]
+    return "".join(a for a, _ in kept), "".join(b for _, b in kept)
+
+
+def grishin_filename(target_name: str, template_name: str) -> str:
+    """
+    <target>_<template>.grishin, with every character of the names that is not safe in a
+    file name (path separators included) replaced by '_'.
+    """
+    safe = ["".join(c if c in FILENAME_CHARS else "_" for c in name) for name in (target_name, template_name)]
+    return "{}_{}.grishin".format(*safe)
+
+
+def write_grishin(
+    path: Path,
+    target_name: str,
+    template_name: str,
+    template_ext: str,
+    target_aln: str,
+    template_aln: str,
+    strip_gaps: bool = False,
+) -> Path:
+    """Write one pairwise Grishin file (optionally without shared gap columns); returns path."""
+    if strip_gaps:
+        target_aln, template_aln = strip_gap_columns(target_aln, template_aln)
+    path.write_text(build_grishin(target_name, template_name, template_ext, target_aln, template_aln))
+    return path
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
-        description="Convert CLUSTAL .aln to Rosetta .grishin (pairwise)."
+        description="Convert a CLUSTAL, aligned FASTA, A3M or Stockholm alignment to Rosetta "
+        ".grishin (pairwise)."
+    )
+    parser.add_argument("aln", help="Input alignment (.aln, .fasta, .a3m, .sto)")
+    parser.add_argument(
+        "--format",
+        choices=["auto", *FORMATS],
+        default="auto",
+        help="Format of the alignment (default: auto, guessed from the start of the file)",
+    )
+    parser.add_argument("--target-id", help="Sequence ID for TARGET")
+    parser.add_argument(
+        "--template-id",
+        action="append",
+        default=[],
+        help="Sequence ID for TEMPLATE (structure). Repeat it, or give a comma separated list, "
+        "to write one Grishin file per template from a single read of the alignment",
+    )
+    parser.add_argument(
+        "--all-templates",
+        action="store_true",
+        help="Use every sequence of the alignment other than the target as a template",
+    )
+    parser.add_argument("-o", "--out", help="Output .grishin file (single template)")
+    parser.add_argument(
+        "--out-dir",
+        default=None,
+        help="Directory for <target-name>_<template>.grishin files, needed with several "
+        "templates (default with several templates: current directory)",
     )
-    parser.add_argument("aln", help="Input CLUSTAL .aln file")
-    parser.add_argument("--target-id", required=True, help="Sequence ID for TARGET")
-    parser.add_argument("--template-id", required=True, help="Sequence ID for TEMPLATE (structure)")
-    parser.add_argument("-o", "--out", required=True, help="Output .grishin file")
 
     parser.add_argument(
         "--target-name",
@@ -136,17 +355,35 @@ def main() -> None:
     parser.add_argument(
         "--template-name",
         default=None,
-        help="Name to write in the Grishin header for TEMPLATE (default: template-id)",
+        help="Name to write in the Grishin header for TEMPLATE (default: template-id; "
+        "single template only)",
     )
     parser.add_argument(
         "--template-ext",
         default=".pdb",
         help="Template file extension written in header (default: .pdb)",
     )
+    parser.add_argument(
+        "--strip-gap-columns",
+        action="store_true",
+        help="Remove the columns that are gaps in both the target and the template of each file",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Threads writing the Grishin files (default: chosen by Python)",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Read the .aln line by line even when it has an index built by aln_index.py",
+    )
     parser.add_argument(
         "--list-ids",
         action="store_true",
-        help="List sequence IDs found in the .aln and exit",
+        help="List sequence IDs found in the alignment and exit",
     )
 
     args = parser.parse_args()
@@ -155,39 +392,113 @@ def main() -> None:
     if not aln_path.exists():
         print(f"ERROR: input file does not exist: {aln_path}", file=sys.stderr)
         sys.exit(2)
-
-    text = aln_path.read_text()
-    seqs = parse_clustal_aln(text)
+    fmt = sniff_format(aln_path) if args.format == "auto" else args.format
+    # A CLUSTAL .aln indexed by aln_index.py is read with seeks instead of line by line
+    index = None if fmt != "clustal" or args.no_index else aln_index.load_index(str(aln_path))
 
     if args.list_ids:
-        print("Sequence IDs found in the .aln file:")
-        for sid in sorted(seqs.keys()):
+        if index is not None:
+            ids = index.ids
+        else:
+            with aln_path.open() as fh:
+                ids = alignment_ids(fh, fmt)
+        print(f"Sequence IDs found in the {fmt} alignment:")
+        for sid in sorted(ids):
             print(f" - {sid}")
         return
 
-    if args.target_id not in seqs or args.template_id not in seqs:
-        print("ERROR: one or both requested IDs were not found in the .aln file.", file=sys.stderr)
+    template_ids = list(dict.fromkeys(t for arg in args.template_id for t in arg.split(",") if t))
+    if not args.target_id:
+        parser.error("--target-id is required")
+    if args.all_templates == bool(template_ids):
+        parser.error("give either --template-id or --all-templates")
+    several = args.all_templates or len(template_ids) > 1
+    if several and (args.out or args.template_name):
+        parser.error("-o/--out and --template-name take a single template; use --out-dir")
+    if not several and not (args.out or args.out_dir):
+        parser.error("-o/--out (or --out-dir) is required")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    # Only the requested sequences are kept while streaming through the alignment
+    keep = None if args.all_templates else {args.target_id, *template_ids}
+    if index is not None:
+        seqs = index.sequences(index.ids if keep is None else keep)
+    else:
+        with aln_path.open() as fh:
+            seqs = read_alignment(fh, fmt, keep=keep)
+    if args.all_templates:
+        template_ids = [sid for sid in seqs if sid != args.target_id]
+
+    missing = [sid for sid in [args.target_id, *template_ids] if sid not in seqs]
+    if missing:
+        print(f"ERROR: one or more requested IDs were not found in the {fmt} alignment.", file=sys.stderr)
         print(f"  target-id  = {args.target_id}", file=sys.stderr)
-        print(f"  template-id= {args.template_id}", file=sys.stderr)
+        print(f"  template-id= {','.join(template_ids)}", file=sys.stderr)
+        print(f"  missing    = {','.join(missing)}", file=sys.stderr)
         print("\nAvailable IDs:", file=sys.stderr)
-        for sid in sorted(seqs.keys()):
+        if index is not None:
+            ids = index.ids
+        else:
+            with aln_path.open() as fh:
+                ids = alignment_ids(fh, fmt)
+        for sid in sorted(ids):
             print(f" - {sid}", file=sys.stderr)
         sys.exit(3)
+    if not template_ids:
+        print("ERROR: the alignment holds no sequence other than the target.", file=sys.stderr)
+        sys.exit(3)
 
     target_name = args.target_name or args.target_id
-    template_name = args.template_name or args.template_id
-
-    grishin_text = build_grishin(
-        target_name=target_name,
-        template_name=template_name,
-        template_ext=args.template_ext,
-        target_aln=seqs[args.target_id],
-        template_aln=seqs[args.template_id],
-    )
 
-    Path(args.out).write_text(grishin_text)
-    print(f"OK: wrote Grishin file to: {args.out}")
+    if not several:
+        template_name = args.template_name or template_ids[0]
+        if args.out:
+            out = Path(args.out)
+        else:
+            Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+            out = Path(args.out_dir) / grishin_filename(target_name, template_name)
+        write_grishin(
+            out,
+            target_name,
+            template_name,
+            args.template_ext,
+            seqs[args.target_id],
+            seqs[template_ids[0]],
+            args.strip_gap_columns,
+        )
+        print(f"OK: wrote Grishin file to: {out}")
+        return
+
+    filenames = {template_id: grishin_filename(target_name, template_id) for template_id in template_ids}
+    clashes = len(template_ids) - len(set(filenames.values()))
+    if clashes:
+        print(
+            f"ERROR: {clashes} templates would share a Grishin file name with another one once "
+            "unsafe characters are replaced; pass them separately with --template-name and -o.",
+            file=sys.stderr,
+        )
+        sys.exit(3)
+
+    out_dir = Path(args.out_dir or ".")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [
+            executor.submit(
+                write_grishin,
+                out_dir / filenames[template_id],
+                target_name,
+                template_id,
+                args.template_ext,
+                seqs[args.target_id],
+                seqs[template_id],
+                args.strip_gap_columns,
+            )
+            for template_id in template_ids
+        ]
+        written = [future.result() for future in futures]
+    print(f"OK: wrote {len(written)} Grishin files to: {out_dir}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+pairwise_align.py
+
+Align a target sequence to one or many template sequences and write each alignment
+as a Rosetta Grishin file (clustal_to_grishin.build_grishin), without a Clustal Omega
+run through the web service.
+
+The alignment is Needleman-Wunsch with affine gaps (Gotoh) and BLOSUM62 scores:
+a gap of k residues costs gap_open + (k - 1) * gap_extend. In the default semi-global
+mode the gaps at the ends of either sequence are free, so a target can overhang the
+template (and a template domain can be left out) at no cost; --mode global scores
+them like inner gaps. The matrices are filled one row of the target at a time with
+numpy, the gaps along the row being resolved with a running maximum, and the
+traceback reads one byte of flags per cell. Ties prefer a match, then a gap in the
+target, and gap extension over a new gap.
+
+Templates are the records of the given FASTA files, or of every *.fasta in the given
+directories (e.g. the <stem>_<chain>.fasta files written by clean_pdb.py), and are
+aligned on a process pool (--jobs).
+
+Example:
+  $ python pairwise_align.py examples/convert_aln_to_grishin/COX3gg.fasta \\
+        examples/convert_aln_to_grishin/COX3hs.fasta -o COX3gg_COX3hs.grishin
+  $ python pairwise_align.py COX3gg.fasta templates/ --out-dir grishin/ --jobs 8
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from clustal_to_grishin import GAPS, grishin_filename, read_alignment, write_grishin
+
+BLOSUM62 = """
+   A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+* -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+"""
+
+GAP_OPEN = 11
+GAP_EXTEND = 1
+
+# Far below any reachable score, without overflowing when penalties are subtracted
+NEG = -(1 << 40)
+
+# Traceback flags of a cell
+H_FROM_E = 1  # best score ends with a gap in the target
+G_FROM_F = 2  # best score without such a gap ends with a gap in the template
+E_OPEN = 4  # the gap in the target opens here (else it extends the one on the left)
+F_OPEN = 8  # the gap in the template opens here (else it extends the one above)
+
+
+def substitution_table(text: str = BLOSUM62) -> np.ndarray:
+    """
+    (256, 256) int64 scores indexed by the bytes of two residues, from a matrix in NCBI
+    layout. Lower case letters score as upper case, anything else as X.
+    """
+    rows = [line.split() for line in text.strip().splitlines()]
+    letters = rows[0]
+    scores = np.array([[int(value) for value in row[1:]] for row in rows[1:]], dtype=np.int64)
+    if scores.shape != (len(letters), len(letters)) or not (scores == scores.T).all():
+        raise ValueError("substitution matrix is not square and symmetric")
+    code = np.full(256, letters.index("X"), dtype=np.int64)
+    for i, letter in enumerate(letters):
+        code[ord(letter)] = i
+        code[ord(letter.lower())] = i
+    return scores[np.ix_(code, code)]
+
+
+SCORES = substitution_table()
+
+
+def _encode(seq: str) -> np.ndarray:
+    return np.frombuffer(seq.encode("ascii", "replace"), dtype=np.uint8)
+
+
+def align(
+    target: str,
+    template: str,
+    mode: str = "semiglobal",
+    gap_open: int = GAP_OPEN,
+    gap_extend: int = GAP_EXTEND,
+    scores: np.ndarray = SCORES,
+) -> Tuple[str, str, int]:
+    """
+    Align target to template. Returns (aligned target, aligned template, score), the
+    aligned sequences with '-' for gaps. mode is 'global' or 'semiglobal' (free end gaps).
+    """
+    a, b = _encode(target), _encode(template)
+    n, m = len(a), len(b)
+    free_ends = mode == "semiglobal"
+    steps = np.arange(m, dtype=np.int64) * gap_extend
+    # Score of the first row and column: leading gaps
+    if free_ends:
+        border_row = np.zeros(m + 1, dtype=np.int64)
+        border_col = np.zeros(n + 1, dtype=np.int64)
+    else:
+        border_row = np.concatenate(([0], -(gap_open + steps)))
+        border_col = np.concatenate(([0], -(gap_open + np.arange(n, dtype=np.int64) * gap_extend)))
+
+    flags = np.zeros((n + 1, m + 1), dtype=np.uint8)
+    last_col = border_col.copy()
+    h = border_row.copy()
+    f = np.full(m, NEG, dtype=np.int64)
+    for i in range(1, n + 1):
+        diag = h[:-1] + scores[a[i - 1], b]
+        f_open = h[1:] - gap_open
+        f_extend = f - gap_extend
+        f = np.maximum(f_open, f_extend)
+        g = np.maximum(diag, f)
+        # Row i from column 0 on, then the gap along it: best opening to the left
+        g_row = np.concatenate(([border_col[i]], g))
+        e = np.maximum.accumulate(g_row[:-1] + steps) - gap_open - steps
+        e_prev = np.concatenate(([NEG], e[:-1]))
+        h = np.concatenate(([border_col[i]], np.maximum(g, e)))
+        flags[i, 1:] = (
+            (e > g) * H_FROM_E
+            + (f > diag) * G_FROM_F
+            + (g_row[:-1] - gap_open > e_prev - gap_extend) * E_OPEN
+            + (f_open > f_extend) * F_OPEN
+        )
+        last_col[i] = h[m]
+
+    # End of the traceback, and the end gaps left after it
+    i, j = n, m
+    if free_ends and n and m:
+        if h.max() >= last_col.max():
+            j = int(np.argmax(h))
+        else:
+            i = int(np.argmax(last_col))
+    score = int(h[j]) if i == n else int(last_col[i])
+
+    out_a: List[str] = ["-"] * (m - j) + list(target[i:][::-1])
+    out_b: List[str] = list(template[j:][::-1]) + ["-"] * (n - i)
+    state = "H"
+    while i > 0 and j > 0:
+        cell = flags[i, j]
+        if state == "H":
+            state = "E" if cell & H_FROM_E else "G"
+        elif state == "G":
+            if cell & G_FROM_F:
+                state = "F"
+            else:
+                out_a.append(target[i - 1])
+                out_b.append(template[j - 1])
+                i, j = i - 1, j - 1
+                state = "H"
+        elif state == "E":
+            out_a.append("-")
+            out_b.append(template[j - 1])
+            state = "G" if cell & E_OPEN else "E"
+            j -= 1
+        else:
+            out_a.append(target[i - 1])
+            out_b.append("-")
+            state = "H" if cell & F_OPEN else "F"
+            i -= 1
+    out_a += list(target[:i][::-1]) + ["-"] * j
+    out_b += ["-"] * i + list(template[:j][::-1])
+    return "".join(reversed(out_a)), "".join(reversed(out_b)), score
+
+
+def read_sequences(path: Path) -> Dict[str, str]:
+    """{record id: sequence} of a FASTA file, gap characters removed."""
+    with path.open() as fh:
+        records = read_alignment(fh, "fasta")
+    return {seq_id: "".join(c for c in seq if c not in GAPS) for seq_id, seq in records.items()}
+
+
+def _align_job(job) -> Tuple[str, int, float, str]:
+    """
+    Process pool entry point: align, write the Grishin file and return
+    (template name, score, identity over aligned pairs, output path).
+    """
+    target_name, target, template_name, template, out, mode, gap_open, gap_extend, template_ext = job
+    target_aln, template_aln, score = align(target, template, mode, gap_open, gap_extend)
+    pairs = [(x, y) for x, y in zip(target_aln, template_aln) if x != "-" and y != "-"]
+    identity = sum(x.upper() == y.upper() for x, y in pairs) / len(pairs) if pairs else 0.0
+    write_grishin(Path(out), target_name, template_name, template_ext, target_aln, template_aln)
+    return template_name, score, identity, out
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(
+        description="Align a target to template sequences (affine-gap BLOSUM62) and write Rosetta .grishin files."
+    )
+    ap.add_argument("target", help="FASTA of the TARGET (first record, or --target-id)")
+    ap.add_argument("templates", nargs="+", help="Template FASTA files, or directories of *.fasta files")
+    ap.add_argument("--target-id", default=None, help="Record of the target FASTA to use")
+    ap.add_argument("--target-name", default=None,
+                    help="Name to write in the Grishin header for TARGET (default: its record id)")
+    ap.add_argument("--template-ext", default=".pdb",
+                    help="Template file extension written in header (default: .pdb)")
+    ap.add_argument("--mode", choices=["semiglobal", "global"], default="semiglobal",
+                    help="semiglobal: free end gaps (default); global: end gaps are penalised")
+    ap.add_argument("--gap-open", type=int, default=GAP_OPEN,
+                    help="Cost of the first residue of a gap (default: %(default)s)")
+    ap.add_argument("--gap-extend", type=int, default=GAP_EXTEND,
+                    help="Cost of every further residue of a gap (default: %(default)s)")
+    ap.add_argument("-o", "--out", help="Output .grishin file (single template)")
+    ap.add_argument("--out-dir", default=None,
+                    help="Directory for <target-name>_<template>.grishin files (default: current directory)")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="Worker processes (default: 1)")
+    args = ap.parse_args()
+
+    if args.jobs < 1:
+        ap.error("--jobs must be at least 1")
+    if args.gap_open < 0 or args.gap_extend < 0:
+        ap.error("gap penalties are costs: give them as positive numbers")
+
+    try:
+        targets = read_sequences(Path(args.target))
+        templates: Dict[str, str] = {}
+        for name in args.templates:
+            path = Path(name)
+            for fasta in sorted(path.glob("*.fasta")) if path.is_dir() else [path]:
+                templates.update(read_sequences(fasta))
+    except OSError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 2
+    target_id = args.target_id or next(iter(targets), None)
+    if target_id not in targets:
+        print(f"ERROR: target {target_id or ''} not found in {args.target}", file=sys.stderr)
+        return 3
+    templates.pop(target_id, None)
+    if not templates:
+        print("ERROR: no template sequences found", file=sys.stderr)
+        return 3
+    if args.out and len(templates) > 1:
+        ap.error("-o/--out takes a single template; use --out-dir")
+
+    target_name = args.target_name or target_id
+    filenames = {name: grishin_filename(target_name, name) for name in templates}
+    if not args.out and len(set(filenames.values())) < len(filenames):
+        print("ERROR: some templates would share a Grishin file name once unsafe characters are replaced",
+              file=sys.stderr)
+        return 3
+    out_dir = Path(args.out_dir or ".")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [
+        (target_name, targets[target_id], name, seq, args.out or str(out_dir / filenames[name]),
+         args.mode, args.gap_open, args.gap_extend, args.template_ext)
+        for name, seq in templates.items()
+    ]
+    if args.jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(_align_job, jobs, chunksize=max(1, len(jobs) // (4 * args.jobs))))
+    else:
+        results = [_align_job(job) for job in jobs]
+
+    for name, score, identity, out in sorted(results, key=lambda result: -result[1]):
+        print(f"{name}\tscore {score}\tidentity {identity:.3f}\t{out}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
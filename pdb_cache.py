@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+pdb_cache.py
+
+Local PDB lookup for clean_pdb.py: a read-only mirror, a persistent content-addressed
+cache and pluggable fetchers for entries that are in neither.
+
+Lookup order for an entry (e.g. 1ABC):
+  1. mirror: a local copy of the wwPDB archive in the standard divided layout,
+     <mirror>/ab/pdb1abc.ent.gz (a flat <mirror>/pdb1abc.ent.gz is accepted as well)
+  2. cache: <cache>/refs/1ABC holds the SHA-256 of the file, stored once under
+     <cache>/objects/<2 hex>/<sha256>. Least recently used objects are evicted when
+     the cache grows past its size limit.
+  3. fetcher: any callable taking a PDB id and returning the (compressed) file bytes.
+     url_fetcher() downloads from a URL template (RCSB by default, or a local HTTP
+     stand-in), directory_fetcher() copies from a local directory, ssh_fetcher()
+     runs wget on a remote host.
+
+Fetched entries are written to the cache, so repeated cleans of the same template
+never touch the network.
+
+Example:
+  $ python pdb_cache.py 1ABC 2XYZ --cache ~/.cache/rosetta_cm_utils/pdb
+  $ python pdb_cache.py --cache ~/.cache/rosetta_cm_utils/pdb --evict --max-size 500
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import urllib.request
+from typing import Callable, Optional
+
+DEFAULT_URL = "https://files.rcsb.org/download/{ID}.pdb.gz"
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "rosetta_cm_utils", "pdb")
+DEFAULT_MAX_MB = 2048
+
+Fetcher = Callable[[str], bytes]
+
+
+def url_fetcher(template: str = DEFAULT_URL, timeout: float = 60.0) -> Fetcher:
+    """
+    Fetcher downloading from a URL template.
+    {id} and {ID} are replaced by the lower/upper case PDB id, {mid} by its middle two characters.
+    """
+
+    def fetch(pdb_id: str) -> bytes:
+        url = format_template(template, pdb_id)
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read()
+
+    return fetch
+
+
+def directory_fetcher(template: str) -> Fetcher:
+    """
+    Fetcher copying from the local filesystem.
+    template is either a path with {id}/{ID}/{mid} placeholders or a directory, in which
+    <dir>/<ID>.pdb.gz, <dir>/<id>.pdb.gz and the divided mirror layout are tried.
+    """
+
+    def fetch(pdb_id: str) -> bytes:
+        if "{" in template:
+            candidates = [format_template(template, pdb_id)]
+        else:
+            candidates = [
+                os.path.join(template, f"{pdb_id.upper()}.pdb.gz"),
+                os.path.join(template, f"{pdb_id.lower()}.pdb.gz"),
+            ]
+            mirrored = mirror_path(template, pdb_id)
+            if mirrored:
+                candidates.append(mirrored)
+        for path in candidates:
+            if os.path.isfile(path):
+                with open(path, "rb") as fh:
+                    return fh.read()
+        raise FileNotFoundError(f"{pdb_id} not found under {template}")
+
+    return fetch
+
+
+def ssh_fetcher(host: str, template: str = DEFAULT_URL) -> Fetcher:
+    """Fetcher running wget on a remote host over ssh and reading the file from its stdout."""
+
+    def fetch(pdb_id: str) -> bytes:
+        url = format_template(template, pdb_id)
+        p = subprocess.run(["ssh", host, "wget", "--quiet", "-O", "-", url], capture_output=True)
+        if p.returncode != 0 or not p.stdout:
+            raise OSError(f"ssh {host} wget {url} failed (returncode={p.returncode})")
+        return p.stdout
+
+    return fetch
+
+
+def make_fetcher(source: Optional[str] = None, remote_host: str = "") -> Fetcher:
+    """Pick a fetcher from a --fetch-url value: http(s)/ftp URL template, or local path/template."""
+    source = source or DEFAULT_URL
+    if source.startswith(("http://", "https://", "ftp://")):
+        return ssh_fetcher(remote_host, source) if remote_host else url_fetcher(source)
+    if source.startswith("file://"):
+        source = source[len("file://") :]
+    return directory_fetcher(source)
+
+
+def format_template(template: str, pdb_id: str) -> str:
+    return template.format(id=pdb_id.lower(), ID=pdb_id.upper(), mid=pdb_id.lower()[1:3])
+
+
+def mirror_path(mirror: str, pdb_id: str) -> Optional[str]:
+    """Return the file of pdb_id in a local wwPDB mirror (divided or flat layout), or None."""
+    pdb_id = pdb_id.lower()
+    for path in (
+        os.path.join(mirror, pdb_id[1:3], f"pdb{pdb_id}.ent.gz"),
+        os.path.join(mirror, f"pdb{pdb_id}.ent.gz"),
+        os.path.join(mirror, pdb_id[1:3], f"pdb{pdb_id}.ent"),
+    ):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def object_path(cache: str, digest: str) -> str:
+    return os.path.join(cache, "objects", digest[:2], digest)
+
+
+def ref_path(cache: str, pdb_id: str) -> str:
+    return os.path.join(cache, "refs", pdb_id.upper())
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write through a temporary file and rename, so concurrent readers never see partial files."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.chmod(tmp, 0o644)  # mkstemp creates private files; the cache may be shared
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def cache_lookup(cache: str, pdb_id: str) -> Optional[str]:
+    """Return the cached file of pdb_id (and mark it as recently used), or None."""
+    try:
+        with open(ref_path(cache, pdb_id), "r") as fh:
+            digest = fh.read().strip()
+    except OSError:
+        return None
+    path = object_path(cache, digest)
+    if not os.path.isfile(path):
+        return None
+    os.utime(path)  # eviction is least-recently-used by mtime
+    return path
+
+
+def cache_store(cache: str, pdb_id: str, data: bytes, max_bytes: Optional[int] = None) -> str:
+    """Store data for pdb_id in the cache and return the object path; evict if over max_bytes."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = object_path(cache, digest)
+    if os.path.isfile(path):
+        os.utime(path)
+    else:
+        write_atomic(path, data)
+    write_atomic(ref_path(cache, pdb_id), (digest + "\n").encode("ascii"))
+    if max_bytes is not None:
+        evict(cache, max_bytes, keep=path)
+    return path
+
+
+def evict(cache: str, max_bytes: int, keep: Optional[str] = None) -> int:
+    """
+    Delete least recently used objects until the cache is at most max_bytes.
+    Refs left pointing to deleted objects are simply misses. Returns the bytes freed.
+    """
+    objects = []
+    total = 0
+    for root, _, files in os.walk(os.path.join(cache, "objects")):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # removed by a concurrent eviction
+            objects.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    freed = 0
+    for _, size, path in sorted(objects):
+        if total - freed <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        freed += size
+    return freed
+
+
+def locate_pdb(
+    pdb_id: str,
+    mirror: Optional[str] = None,
+    cache: Optional[str] = DEFAULT_CACHE,
+    fetcher: Optional[Fetcher] = None,
+    max_bytes: Optional[int] = DEFAULT_MAX_MB * 1024 * 1024,
+) -> Optional[str]:
+    """
+    Return a local path for pdb_id from the mirror or the cache, fetching it into the
+    cache if needed. Returns None when there is no cache and the entry is not mirrored,
+    so the caller can fetch it by other means.
+    """
+    if mirror:
+        path = mirror_path(mirror, pdb_id)
+        if path:
+            return path
+    if not cache:
+        return None
+    path = cache_lookup(cache, pdb_id)
+    if path:
+        return path
+    data = (fetcher or url_fetcher())(pdb_id)
+    return cache_store(cache, pdb_id, data, max_bytes)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Pre-fetch PDB entries into the local cache, or trim the cache.")
+    ap.add_argument("ids", nargs="*", help="PDB ids to fetch")
+    ap.add_argument("--cache", default=os.environ.get("PDB_CACHE", DEFAULT_CACHE),
+                    help="Cache directory (default: $PDB_CACHE or %(default)s)")
+    ap.add_argument("--mirror", default=os.environ.get("PDB_MIRROR"),
+                    help="Local wwPDB mirror in divided layout (default: $PDB_MIRROR)")
+    ap.add_argument("--fetch-url", default=os.environ.get("PDB_FETCH_URL", DEFAULT_URL),
+                    help="URL template or local directory to fetch from (default: %(default)s)")
+    ap.add_argument("--max-size", type=int, default=DEFAULT_MAX_MB,
+                    help="Cache size limit in MB (default: %(default)s)")
+    ap.add_argument("--evict", action="store_true", help="Only trim the cache to --max-size and exit")
+    args = ap.parse_args()
+
+    max_bytes = args.max_size * 1024 * 1024
+    if args.evict:
+        freed = evict(args.cache, max_bytes)
+        print(f"Freed {freed} bytes from {args.cache}")
+        return 0
+
+    fetcher = make_fetcher(args.fetch_url)
+    status = 0
+    for pdb_id in args.ids:
+        try:
+            path = locate_pdb(pdb_id, args.mirror, args.cache, fetcher, max_bytes)
+        except Exception as e:
+            print(f"ERROR: could not fetch {pdb_id}: {e}", file=sys.stderr)
+            status = 1
+            continue
+        print(f"{pdb_id}\t{path}")
+    return status
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
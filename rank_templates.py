@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+rank_templates.py
+
+Rank the sequences of a multiple-sequence alignment as templates for a target, before
+choosing the ones to convert with clustal_to_grishin.py.
+
+The alignment (CLUSTAL, aligned FASTA, A3M or Stockholm, read as in clustal_to_grishin)
+is encoded once as a uint8 matrix, one row per sequence, and every metric is computed
+for the target against all the other rows at once, in blocks of CHUNK_ROWS rows:
+
+  identity     identical residues / aligned pairs (columns with a residue in both)
+  similarity   pairs in the same amino_acids.hpcg group (hydrophobic, polar, charged,
+               glycine) / aligned pairs
+  coverage     aligned pairs / residues of the target
+  gap_opens    gap openings in the pairwise alignment (columns that are gaps in both
+               sequences are left out, as clustal_to_grishin --strip-gap-columns does)
+  longest_unaligned
+               longest run of consecutive target residues facing gaps in the template
+
+The table is sorted by --sort (identity by default, then coverage) and written as
+tab separated text.
+
+Example:
+  $ python rank_templates.py family.aln --target-id COX3gg --top 20
+  $ python rank_templates.py hits.a3m --target-id query --min-coverage 0.6 --sort similarity -o ranking.tsv
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import aln_index
+from amino_acids import hpcg
+from clustal_to_grishin import FORMATS, GAPS, read_alignment, sniff_format
+
+# Rows of the alignment processed together (bounds the size of the temporary arrays)
+CHUNK_ROWS = 4096
+
+COLUMNS = ["identity", "similarity", "coverage", "aligned", "gap_opens", "longest_unaligned"]
+SORT_KEYS = ["identity", "similarity", "coverage", "gap_opens", "longest_unaligned"]
+
+# Byte -> upper case byte
+UPPER = np.arange(256, dtype=np.uint8)
+UPPER[ord("a") : ord("z") + 1] -= 32
+
+# Byte -> hpcg group (0 for anything that is not one of the 20 amino acids)
+GROUP = np.zeros(256, dtype=np.uint8)
+for _letter, _group in hpcg.items():
+    GROUP[ord(_letter)] = ord(_group)
+
+IS_GAP = np.zeros(256, dtype=bool)
+IS_GAP[[ord(gap) for gap in GAPS]] = True
+
+
+def encode_alignment(seqs: Dict[str, str]) -> Tuple[List[str], np.ndarray]:
+    """
+    The ids and the (sequences, columns) uint8 matrix of an alignment, upper case.
+    Raises ValueError when the aligned sequences do not all have the same length.
+    """
+    ids = list(seqs)
+    lengths = {len(seq) for seq in seqs.values()}
+    if len(lengths) > 1:
+        raise ValueError("aligned sequences of different lengths (%s)" % ", ".join(map(str, sorted(lengths))))
+    width = lengths.pop() if lengths else 0
+    data = "".join(seqs.values()).encode("ascii", "replace")
+    return ids, UPPER[np.frombuffer(data, dtype=np.uint8).reshape(len(ids), width)]
+
+
+def _longest_run(mask: np.ndarray) -> np.ndarray:
+    """Length of the longest run of True along each row of a 2D boolean array."""
+    n, width = mask.shape
+    # A False column on both sides of every row, so that no run crosses rows
+    padded = np.zeros((n, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded.ravel())
+    starts = np.flatnonzero(edges == 1)
+    lengths = np.flatnonzero(edges == -1) - starts
+    longest = np.zeros(n, dtype=np.int64)
+    np.maximum.at(longest, starts // (width + 2), lengths)
+    return longest
+
+
+def _gap_opens(target_residue: np.ndarray, residue: np.ndarray) -> np.ndarray:
+    """Gap openings of each row against the target, skipping columns that are gaps in both."""
+    n, width = residue.shape
+    # 0 aligned pair, 1 gap in the template, 2 gap in the target, -1 gap in both; every
+    # row starts with an aligned column, so that a leading gap is an opening and no
+    # gap carries over from the previous row
+    state = np.zeros((n, width + 1), dtype=np.int8)
+    state[:, 1:] = np.where(target_residue, np.where(residue, 0, 1), np.where(residue, 2, -1))
+    flat = state.ravel()
+    kept = np.flatnonzero(flat >= 0)
+    states = flat[kept]
+    opens = np.flatnonzero((states[1:] > 0) & (states[1:] != states[:-1])) + 1
+    return np.bincount(kept[opens] // (width + 1), minlength=n)
+
+
+def rank_metrics(matrix: np.ndarray, target: int) -> Dict[str, np.ndarray]:
+    """
+    The metrics of the module docstring for row target against every row of matrix
+    (the target row included), as {column name: array with one value per row}.
+    """
+    target_seq = matrix[target]
+    target_residue = ~IS_GAP[target_seq]
+    target_group = GROUP[target_seq]
+    n_target = int(target_residue.sum())
+
+    parts: Dict[str, List[np.ndarray]] = {name: [] for name in COLUMNS}
+    for first in range(0, len(matrix), CHUNK_ROWS):
+        block = matrix[first : first + CHUNK_ROWS]
+        residue = ~IS_GAP[block]
+        aligned = residue & target_residue
+        n_aligned = aligned.sum(axis=1)
+        identical = (aligned & (block == target_seq)).sum(axis=1)
+        similar = (aligned & (GROUP[block] == target_group) & (target_group != 0)).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            parts["identity"].append(np.where(n_aligned > 0, identical / n_aligned, 0.0))
+            parts["similarity"].append(np.where(n_aligned > 0, similar / n_aligned, 0.0))
+        parts["coverage"].append(n_aligned / n_target if n_target else np.zeros(len(block)))
+        parts["aligned"].append(n_aligned)
+        parts["gap_opens"].append(_gap_opens(target_residue, residue))
+        parts["longest_unaligned"].append(_longest_run(~residue[:, target_residue]))
+    return {name: np.concatenate(values) for name, values in parts.items()}
+
+
+def rank_order(metrics: Dict[str, np.ndarray], sort: str, exclude: int) -> np.ndarray:
+    """Rows sorted best first by sort, then coverage, then identity; row exclude left out."""
+    # Higher is better for the fractions, lower for the gap counts
+    sign = -1 if sort in ("identity", "similarity", "coverage") else 1
+    order = np.lexsort((-metrics["identity"], -metrics["coverage"], sign * metrics[sort]))
+    return order[order != exclude]
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Rank the sequences of an alignment as templates for a target.")
+    ap.add_argument("aln", help="Alignment (.aln, .fasta, .a3m, .sto)")
+    ap.add_argument("--target-id", required=True, help="Sequence ID of the TARGET")
+    ap.add_argument("--format", choices=["auto", *FORMATS], default="auto",
+                    help="Format of the alignment (default: auto, guessed from the start of the file)")
+    ap.add_argument("--sort", choices=SORT_KEYS, default="identity",
+                    help="Metric to rank by (default: %(default)s; ties by coverage, then identity)")
+    ap.add_argument("--min-coverage", type=float, default=0.0,
+                    help="Leave out templates covering less than this fraction of the target")
+    ap.add_argument("--top", type=int, default=None, help="Only the N best templates")
+    ap.add_argument("-o", "--output", help="Write the table here instead of stdout")
+    args = ap.parse_args()
+
+    aln_path = Path(args.aln)
+    if not aln_path.exists():
+        print(f"ERROR: input file does not exist: {aln_path}", file=sys.stderr)
+        return 2
+    fmt = sniff_format(aln_path) if args.format == "auto" else args.format
+    index = aln_index.load_index(str(aln_path)) if fmt == "clustal" else None
+    if index is not None:
+        seqs = index.sequences(index.ids)
+    else:
+        with aln_path.open() as fh:
+            seqs = read_alignment(fh, fmt)
+
+    try:
+        ids, matrix = encode_alignment(seqs)
+    except ValueError as e:
+        print(f"ERROR: {aln_path}: {e}", file=sys.stderr)
+        return 2
+    if args.target_id not in seqs:
+        print(f"ERROR: target-id {args.target_id} not found in the {fmt} alignment.", file=sys.stderr)
+        return 3
+
+    target = ids.index(args.target_id)
+    metrics = rank_metrics(matrix, target)
+    order = rank_order(metrics, args.sort, target)
+    order = order[metrics["coverage"][order] >= args.min_coverage]
+    if args.top is not None:
+        order = order[: args.top]
+
+    lines = ["\t".join(["rank", "template_id", *COLUMNS])]
+    for rank, row in enumerate(order.tolist(), 1):
+        lines.append(
+            f"{rank}\t{ids[row]}\t{metrics['identity'][row]:.3f}\t{metrics['similarity'][row]:.3f}\t"
+            f"{metrics['coverage'][row]:.3f}\t{metrics['aligned'][row]}\t{metrics['gap_opens'][row]}\t"
+            f"{metrics['longest_unaligned'][row]}"
+        )
+    text = "\n".join(lines) + "\n"
+    if args.output:
+        Path(args.output).write_text(text)
+        print(f"OK: ranked {len(order)} templates for {args.target_id} in: {args.output}", file=sys.stderr)
+    else:
+        sys.stdout.write(text)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+residue_mapping.py
+
+Read Rosetta Grishin alignments (as written by clustal_to_grishin.py and
+pairwise_align.py) and turn them into residue correspondences between target and
+template, so that threading, span projection and QC code can map a residue with one
+array lookup instead of walking the gapped strings.
+
+Grishin format:
+  ## <TARGET_NAME> <TEMPLATE_NAME>.pdb
+  #
+  scores from program: 0
+  <start> <TARGET_ALIGNED_SEQUENCE>
+  <start> <TEMPLATE_ALIGNED_SEQUENCE>
+
+start is the 0-based position in its sequence of the first residue of the aligned
+sequence. A file may hold several alignments, each starting with its '##' line (and
+optionally separated by '--' lines).
+
+ResidueMapping.target_to_template[i] is the 0-based position in the template sequence
+of the residue aligned to target residue i, or -1 when it faces a gap (or lies outside
+the aligned region); template_to_target is the reverse. Both arrays are built on first
+use, cached and read-only.
+
+Example:
+  $ python residue_mapping.py examples/threading/COX3gg_COX3hs.grishin
+  >>> from residue_mapping import read_grishin
+  >>> mapping = read_grishin("COX3gg_COX3hs.grishin")[0]
+  >>> mapping.target_to_template[41]        # template position of target residue 42
+  >>> mapping.aligned_pairs                 # (pairs, 2) array of target, template positions
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from functools import cached_property
+from typing import List
+
+import numpy as np
+
+from clustal_to_grishin import GAPS
+
+IS_GAP = np.zeros(256, dtype=bool)
+IS_GAP[[ord(gap) for gap in GAPS]] = True
+
+
+def _read_only(values: np.ndarray) -> np.ndarray:
+    values.setflags(write=False)
+    return values
+
+
+class ResidueMapping:
+    """
+    One pairwise alignment: names, aligned sequences and start positions, with the
+    residue correspondence arrays computed once on first use.
+    """
+
+    def __init__(
+        self,
+        target_aln: str,
+        template_aln: str,
+        target_name: str = "",
+        template_name: str = "",
+        target_start: int = 0,
+        template_start: int = 0,
+    ):
+        if len(target_aln) != len(template_aln):
+            raise ValueError(
+                "aligned sequences of different lengths (%d and %d)" % (len(target_aln), len(template_aln))
+            )
+        self.target_aln = target_aln
+        self.template_aln = template_aln
+        self.target_name = target_name
+        self.template_name = template_name
+        self.target_start = target_start
+        self.template_start = template_start
+
+    @cached_property
+    def _columns(self):
+        """Per column: residue in target, residue in template, and their sequence positions."""
+        target = ~IS_GAP[np.frombuffer(self.target_aln.encode("ascii", "replace"), dtype=np.uint8)]
+        template = ~IS_GAP[np.frombuffer(self.template_aln.encode("ascii", "replace"), dtype=np.uint8)]
+        target_pos = np.cumsum(target) - 1 + self.target_start
+        template_pos = np.cumsum(template) - 1 + self.template_start
+        return target, template, target_pos, template_pos
+
+    @property
+    def target_length(self) -> int:
+        """Residues of the target up to the end of the alignment (start included)."""
+        return self.target_start + int(self._columns[0].sum())
+
+    @property
+    def template_length(self) -> int:
+        """Residues of the template up to the end of the alignment (start included)."""
+        return self.template_start + int(self._columns[1].sum())
+
+    @cached_property
+    def aligned_pairs(self) -> np.ndarray:
+        """(pairs, 2) int64 array of the (target, template) positions aligned to each other."""
+        target, template, target_pos, template_pos = self._columns
+        both = target & template
+        return _read_only(np.stack([target_pos[both], template_pos[both]], axis=1))
+
+    @cached_property
+    def target_to_template(self) -> np.ndarray:
+        """Template position of every target residue, -1 where there is none."""
+        mapping = np.full(self.target_length, -1, dtype=np.int64)
+        mapping[self.aligned_pairs[:, 0]] = self.aligned_pairs[:, 1]
+        return _read_only(mapping)
+
+    @cached_property
+    def template_to_target(self) -> np.ndarray:
+        """Target position of every template residue, -1 where there is none."""
+        mapping = np.full(self.template_length, -1, dtype=np.int64)
+        mapping[self.aligned_pairs[:, 1]] = self.aligned_pairs[:, 0]
+        return _read_only(mapping)
+
+    @cached_property
+    def identity(self) -> float:
+        """Identical residues / aligned pairs (0 without aligned pairs)."""
+        target, template, _, _ = self._columns
+        both = target & template
+        if not both.any():
+            return 0.0
+        a = np.frombuffer(self.target_aln.upper().encode("ascii", "replace"), dtype=np.uint8)
+        b = np.frombuffer(self.template_aln.upper().encode("ascii", "replace"), dtype=np.uint8)
+        return float((a[both] == b[both]).mean())
+
+    def template_residue(self, target_position: int) -> int:
+        """Template position aligned to target_position (0-based), -1 for none."""
+        if 0 <= target_position < len(self.target_to_template):
+            return int(self.target_to_template[target_position])
+        return -1
+
+    def target_residue(self, template_position: int) -> int:
+        """Target position aligned to template_position (0-based), -1 for none."""
+        if 0 <= template_position < len(self.template_to_target):
+            return int(self.template_to_target[template_position])
+        return -1
+
+
+def parse_grishin(text: str) -> List[ResidueMapping]:
+    """
+    Parse the text of a Grishin file into one ResidueMapping per alignment.
+
+    Rules:
+    - '## <target> <template>' starts an alignment (the template name is kept as written,
+      e.g. with its .pdb extension).
+    - Other lines starting with '#', 'scores from program', '--' and empty lines are skipped.
+    - The next two '<start> <sequence>' lines are the target and the template.
+    Raises ValueError on an alignment without its two sequence lines.
+    """
+    mappings: List[ResidueMapping] = []
+    names: List[str] = []
+    rows: List[tuple[int, str]] = []
+
+    def close():
+        if not names and not rows:
+            return
+        if len(rows) != 2:
+            raise ValueError("alignment %s has %d sequence lines instead of 2" % (" ".join(names) or "?", len(rows)))
+        (target_start, target_aln), (template_start, template_aln) = rows
+        mappings.append(
+            ResidueMapping(
+                target_aln,
+                template_aln,
+                names[0] if names else "",
+                names[1] if len(names) > 1 else "",
+                target_start,
+                template_start,
+            )
+        )
+
+    for line in text.splitlines():
+        if line.startswith("##"):
+            close()
+            names, rows = line[2:].split(), []
+            continue
+        stripped = line.strip()
+        if not stripped or stripped.startswith(("#", "--", "scores from program")):
+            continue
+        parts = stripped.split()
+        if len(parts) != 2 or not parts[0].lstrip("-").isdigit():
+            raise ValueError("unexpected line in Grishin alignment: %r" % line)
+        rows.append((int(parts[0]), parts[1]))
+    close()
+    return mappings
+
+
+def read_grishin(path: str) -> List[ResidueMapping]:
+    """The alignments of a Grishin file (see parse_grishin())."""
+    with open(path) as fh:
+        return parse_grishin(fh.read())
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Summarise the residue correspondences of Grishin alignments.")
+    ap.add_argument("grishin", nargs="+", help=".grishin files")
+    args = ap.parse_args()
+
+    failed = 0
+    for path in args.grishin:
+        try:
+            mappings = read_grishin(path)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {path}: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        for mapping in mappings:
+            print(
+                f"{path}: {mapping.target_name} -> {mapping.template_name}: "
+                f"{len(mapping.aligned_pairs)} aligned pairs, {mapping.target_length} target and "
+                f"{mapping.template_length} template residues, identity {mapping.identity:.3f}"
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+structure_archive.py
+
+Binary sidecar of a cleaned structure, written by clean_pdb.py --archive next to the
+cleaned PDB and fasta as <stem>_<chain>.cln, so that later stages (threading, QC,
+template inspection) can use the atoms without parsing the PDB text again.
+
+The file is columnar: a header followed by one contiguous block per column, each
+starting on an 8-byte boundary, in the order of ATOM_FIELDS then RESIDUE_FIELDS:
+
+  header   '<8sHHII': magic, format version, reserved, number of atoms, number of residues
+  atoms    xyz (float32 x 3), occupancy, bfactor (float32), name (S4), resn (S3),
+           chain (S1), element (S2), hetatm (bool), residue (int32, row in the residue
+           columns)
+  residues number (int32, as written to the cleaned PDB), chain (S1), original (S5, the
+           residue number and insertion code in the input: the renumbering map),
+           letter (S1, one-letter code), first_atom (int32)
+
+At 35 bytes per atom the file is under half the size of the PDB text. It is not
+compressed, so that load() can memory-map it: the columns are read-only numpy views of
+the file and loading takes the same time whatever the size of the structure.
+
+Example:
+  $ python clean_pdb.py 1abc.pdb A --archive
+  $ python structure_archive.py 1abc_A.cln
+  >>> import structure_archive
+  >>> structure = structure_archive.load("1abc_A.cln")
+  >>> structure.sequence()["A"]
+  >>> structure.xyz[structure.atoms_of(9)]        # atoms of the 10th residue
+  >>> structure.renumbering()[("A", "  42A")]     # cleaned number of input residue 42A
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from atom_table import LETTER_CODES, LETTERS, SPACE, lookup, read_atom_table, residue_code, restore_columns
+
+MAGIC = b"CLNSTRUC"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sHHII")
+ALIGN = 8
+
+# (name, numpy format, values per row) of the columns, in file order
+ATOM_FIELDS = [
+    ("xyz", "<f4", 3),
+    ("occupancy", "<f4", 1),
+    ("bfactor", "<f4", 1),
+    ("name", "S4", 1),
+    ("resn", "S3", 1),
+    ("chain", "S1", 1),
+    ("element", "S2", 1),
+    ("hetatm", "?", 1),
+    ("residue", "<i4", 1),
+]
+RESIDUE_FIELDS = [
+    ("number", "<i4", 1),
+    ("chain", "S1", 1),
+    ("original", "S5", 1),
+    ("letter", "S1", 1),
+    ("first_atom", "<i4", 1),
+]
+
+
+def archive_name(pdb_name: str) -> str:
+    """The sidecar of a cleaned PDB: <stem>_<chain>.cln for <stem>_<chain>.pdb[.gz|.bz2|.xz]."""
+    for suffix in (".gz", ".bz2", ".xz"):
+        if pdb_name.endswith(suffix):
+            pdb_name = pdb_name[: -len(suffix)]
+    if pdb_name.endswith(".pdb"):
+        pdb_name = pdb_name[:-4]
+    return pdb_name + ".cln"
+
+
+def _float_column(matrix: np.ndarray, first: int, width: int) -> np.ndarray:
+    """Parse columns first..first+width of every record as float32; blank fields are 0."""
+    field = np.ascontiguousarray(matrix[:, first : first + width]).view("S%d" % width)[:, 0]
+    blank = np.all(matrix[:, first : first + width] == SPACE, axis=1)
+    values = np.zeros(len(matrix), dtype=np.float32)
+    values[~blank] = field[~blank].astype(np.float64)
+    return values
+
+
+def columns_from_text(text: str, renumbering: Optional[Sequence[str]] = None):
+    """
+    Parse cleaned PDB text (as written by clean_pdb) into the atom and residue columns.
+
+    renumbering is the input residue number of every residue, in order (see
+    CleanContext.renumbering in clean_pdb.py); without it the original column is blank.
+    Returns (atoms, residues), two {field name: array} dicts.
+    """
+    table, matrix, lengths, _ = read_atom_table(text, "", True)
+    numbers, lengths = restore_columns(matrix, lengths)
+    n = len(table)
+
+    starts = np.ones(n, dtype=bool)
+    starts[1:] = (numbers[1:] != numbers[:-1]) | (table["chain"][1:] != table["chain"][:-1])
+    residue = np.cumsum(starts) - 1
+    first_atom = np.flatnonzero(starts)
+
+    xyz = np.ascontiguousarray(matrix[:, 30:54]).view("S8").astype(np.float32) if n else np.zeros((0, 3), np.float32)
+    atoms = {
+        "xyz": xyz,
+        "occupancy": _float_column(matrix, 54, 6),
+        "bfactor": _float_column(matrix, 60, 6),
+        "name": table["name"].copy(),
+        "resn": table["resn"].copy(),
+        "chain": table["chain"].copy(),
+        "element": table["element"].copy(),
+        "hetatm": table["record"] == b"HETATM",
+        "residue": residue,
+    }
+
+    known, letter = lookup(residue_code(matrix[first_atom, 17:20]), LETTER_CODES)
+    letters = np.where(known, LETTERS[letter], ord("X")).astype(np.uint8).view("S1")
+    original = np.full(len(first_atom), b"     ", dtype="S5")
+    if renumbering is not None:
+        if len(renumbering) != len(first_atom):
+            raise ValueError("%d residue numbers given for %d residues" % (len(renumbering), len(first_atom)))
+        original[:] = [number.encode("latin-1") for number in renumbering]
+    residues = {
+        "number": numbers[first_atom],
+        "chain": table["chain"][first_atom],
+        "original": original,
+        "letter": letters,
+        "first_atom": first_atom,
+    }
+    return atoms, residues
+
+
+def _blocks(fields, columns, count):
+    for name, fmt, per_row in fields:
+        shape = (count, per_row) if per_row > 1 else (count,)
+        yield np.ascontiguousarray(columns[name], dtype=fmt).reshape(shape)
+
+
+def write_archive(path: str, text: str, renumbering: Optional[Sequence[str]] = None) -> Tuple[int, int]:
+    """Write the cleaned PDB text as an archive at path, atomically. Returns (atoms, residues)."""
+    atoms, residues = columns_from_text(text, renumbering)
+    n_atoms, n_residues = len(atoms["residue"]), len(residues["number"])
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, n_atoms, n_residues))
+        for block in list(_blocks(ATOM_FIELDS, atoms, n_atoms)) + list(_blocks(RESIDUE_FIELDS, residues, n_residues)):
+            fh.write(b"\0" * (-fh.tell() % ALIGN))
+            fh.write(block.tobytes())
+    os.replace(tmp, path)
+    return n_atoms, n_residues
+
+
+class CleanedStructure:
+    """
+    A loaded archive. Every field of ATOM_FIELDS and RESIDUE_FIELDS is an attribute: the
+    atom ones under their own name (xyz, name, chain, ...) and the residue ones prefixed
+    with 'residue_' (residue_number, residue_chain, residue_original, ...).
+    """
+
+    def __init__(self, path: str, n_atoms: int, n_residues: int, columns: Dict[str, np.ndarray]):
+        self.path = path
+        self.n_atoms = n_atoms
+        self.n_residues = n_residues
+        for name, values in columns.items():
+            setattr(self, name, values)
+
+    def atoms_of(self, residue: int) -> slice:
+        """Rows of the atom columns of residue (0-based row of the residue columns)."""
+        end = self.residue_first_atom[residue + 1] if residue + 1 < self.n_residues else self.n_atoms
+        return slice(int(self.residue_first_atom[residue]), int(end))
+
+    def sequence(self) -> Dict[str, str]:
+        """{chain: one-letter sequence}, chains in order of first appearance (as in the fasta)."""
+        chains: Dict[str, List[bytes]] = {}
+        for chain, letter in zip(self.residue_chain.tolist(), self.residue_letter.tolist()):
+            chains.setdefault(chain.decode("latin-1"), []).append(letter)
+        return {chain: b"".join(letters).decode("latin-1") for chain, letters in chains.items()}
+
+    def renumbering(self) -> Dict[Tuple[str, str], int]:
+        """{(chain, input residue number and insertion code): cleaned residue number}."""
+        return {
+            (chain.decode("latin-1"), original.decode("latin-1")): number
+            for chain, original, number in zip(
+                self.residue_chain.tolist(), self.residue_original.tolist(), self.residue_number.tolist()
+            )
+        }
+
+
+def load(path: str) -> CleanedStructure:
+    """Memory-map an archive written by write_archive()."""
+    with open(path, "rb") as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < HEADER.size:
+        raise ValueError("%s: truncated archive" % path)
+    magic, version, _, n_atoms, n_residues = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("%s: not a version %d cleaned-structure archive" % (path, FORMAT_VERSION))
+
+    columns: Dict[str, np.ndarray] = {}
+    offset = HEADER.size
+    for prefix, fields, count in (("", ATOM_FIELDS, n_atoms), ("residue_", RESIDUE_FIELDS, n_residues)):
+        for name, fmt, per_row in fields:
+            offset += -offset % ALIGN
+            dtype = np.dtype(fmt)
+            if offset + dtype.itemsize * count * per_row > len(data):
+                raise ValueError("%s: truncated archive" % path)
+            values = np.frombuffer(data, dtype=dtype, count=count * per_row, offset=offset)
+            columns[prefix + name] = values.reshape(count, per_row) if per_row > 1 else values
+            offset += dtype.itemsize * count * per_row
+    return CleanedStructure(path, n_atoms, n_residues, columns)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Summarise cleaned-structure archives written by clean_pdb.py --archive.")
+    ap.add_argument("archives", nargs="+", help="<stem>_<chain>.cln files")
+    args = ap.parse_args()
+
+    failed = 0
+    for path in args.archives:
+        try:
+            structure = load(path)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        print(f"{path}: {structure.n_atoms} atoms, {structure.n_residues} residues")
+        for chain, seq in structure.sequence().items():
+            print(f">{chain.strip() or '_'}\n{seq}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
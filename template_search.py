@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+template_search.py
+
+k-mer index of a local template library, to find the templates of a target in
+milliseconds before aligning them (pairwise_align.py, clustal_to_grishin.py).
+
+The library is given as FASTA files, directories of *.fasta (e.g. the <stem>_<chain>.fasta
+files written by clean_pdb.py) or a wwPDB seqres dump (pdb_seqres.txt[.gz], whose
+mol:na records are skipped). Every template is indexed by the distinct k-mers of its
+sequence (k = 4 by default, over the 20 amino acids).
+
+The index is a directory of segments, each one memory-mapped at query time:
+
+  segment_NNNN.kmi  header '<8sHHIQQ': magic, format version, k, number of templates,
+                    number of postings, bytes of sequence; then, each starting on an
+                    8-byte boundary: offsets (int64, 20**k + 1), postings (int32,
+                    template row of every k-mer, grouped by k-mer), kmer_counts (int32,
+                    distinct k-mers per template), sequence_offsets (int64) and
+                    sequences, name_offsets (int64) and names
+  segment_NNNN.del  optional bool per template: replaced by a later segment
+
+Building again over an existing index adds a segment with the new templates and those
+whose sequence changed (marking the old copies in .del); when there are more than
+MAX_SEGMENTS segments they are merged into one.
+
+A query counts, for every template, the k-mers it shares with the target, from the
+postings of the target's k-mers only. The approximate identity is the fraction of
+shared k-mers (over the smaller k-mer set), corrected for chance matches and taken to
+the power 1/k, since a k-mer survives in a pair at identity p with probability p**k.
+
+Example:
+  $ python template_search.py build templates.kmi templates/ pdb_seqres.txt.gz
+  $ python template_search.py query templates.kmi COX3gg.fasta --top 10 --fasta-out hits.fasta
+  $ python pairwise_align.py COX3gg.fasta hits.fasta --out-dir grishin/
+
+Maintained by:
+  Name(s):        Carolina Simón Guerrero, Jose Luis Cabrera Alarcón, Marina Rosa Moreno
+  Email(s):       carolina.simon.guerrero@gmail.com, joseluis.cabrera@cnic.es, marina.rosa@cnic.es
+
+Institution:
+  Name:           Spanish National Centre for Cardiovascular Research - CNIC
+  Unit/Group:     Functional Genetics of the Oxidative Phosphorylation System (GENOXPHOS) Lab
+  Address:        Madrid, Spain
+  Website:        https://www.cnic.es/en/investigacion/functional-genetics-oxidative-phosphorylation-system-genoxphos
+
+Repository/URL:    https://github.com/csimong/rosetta_cm_utils
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import mmap
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from amino_acids import amino_acids
+
+MAGIC = b"KMERSEGM"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sHHIQQ")
+ALIGN = 8
+DEFAULT_K = 4
+MAX_SEGMENTS = 8
+
+ALPHABET = len(amino_acids)
+# Byte -> index of the amino acid, ALPHABET for anything else (k-mers with it are skipped)
+CODE = np.full(256, ALPHABET, dtype=np.int64)
+for _i, _letter in enumerate(amino_acids):
+    CODE[ord(_letter)] = _i
+    CODE[ord(_letter.lower())] = _i
+
+
+def read_templates(path: Path) -> Iterator[Tuple[str, str]]:
+    """
+    Yield (id, sequence) for the records of a FASTA file (gzipped or not). The id is the
+    first word of the header; seqres records marked mol:na are skipped.
+    """
+    with open(path, "rb") as fh:
+        gzipped = fh.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gzipped else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as fh:
+        name, parts, skip = None, [], False
+        for line in fh:
+            if line.startswith(">"):
+                if name and parts and not skip:
+                    yield name, "".join(parts)
+                fields = line[1:].split()
+                name, parts, skip = (fields[0] if fields else ""), [], "mol:na" in fields
+            elif name is not None and not skip:
+                parts.append(line.strip())
+        if name and parts and not skip:
+            yield name, "".join(parts)
+
+
+def library_sequences(sources: Iterable[str]) -> Dict[str, str]:
+    """{template id: sequence} of FASTA files and directories of *.fasta; later ids win."""
+    templates: Dict[str, str] = {}
+    for source in sources:
+        path = Path(source)
+        for fasta in sorted(path.glob("*.fasta")) if path.is_dir() else [path]:
+            templates.update(read_templates(fasta))
+    return templates
+
+
+def kmer_codes(seq: str, k: int) -> np.ndarray:
+    """Sorted distinct k-mers of seq as integers in [0, 20**k); k-mers with unknown residues are left out."""
+    codes = CODE[np.frombuffer(seq.encode("ascii", "replace"), dtype=np.uint8)]
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    valid = (windows < ALPHABET).all(axis=1)
+    return np.unique(windows[valid] @ (ALPHABET ** np.arange(k - 1, -1, -1, dtype=np.int64)))
+
+
+def _offsets(lengths: List[int]) -> np.ndarray:
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+
+def write_segment(path: str, templates: List[Tuple[str, str]], k: int) -> None:
+    """Write the templates ((id, sequence) pairs) as one segment, atomically."""
+    kmers = [kmer_codes(seq, k) for _, seq in templates]
+    counts = np.array([len(codes) for codes in kmers], dtype=np.int32)
+    all_kmers = np.concatenate(kmers) if kmers else np.zeros(0, dtype=np.int64)
+    rows = np.repeat(np.arange(len(templates), dtype=np.int32), counts)
+    order = np.argsort(all_kmers, kind="stable")
+    postings = rows[order]
+    offsets = _offsets(np.bincount(all_kmers, minlength=ALPHABET ** k).tolist())
+
+    sequences = [seq.encode("ascii", "replace") for _, seq in templates]
+    names = [name.encode("utf-8") for name, _ in templates]
+    blocks = [
+        offsets,
+        postings,
+        counts,
+        _offsets([len(seq) for seq in sequences]),
+        np.frombuffer(b"".join(sequences), dtype=np.uint8),
+        _offsets([len(name) for name in names]),
+        np.frombuffer(b"".join(names), dtype=np.uint8),
+    ]
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, k, len(templates), len(postings), len(blocks[4])))
+        for block in blocks:
+            fh.write(b"\0" * (-fh.tell() % ALIGN))
+            fh.write(block.tobytes())
+    os.replace(tmp, path)
+
+
+class Segment:
+    """A memory-mapped segment (see the module docstring)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) < HEADER.size:
+            raise ValueError("%s: truncated segment" % path)
+        magic, version, k, n, n_postings, n_bytes = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("%s: not a version %d k-mer index segment" % (path, FORMAT_VERSION))
+        self.k, self.n = k, n
+        offset = HEADER.size
+
+        def column(dtype, count):
+            nonlocal offset
+            offset += -offset % ALIGN
+            if offset + np.dtype(dtype).itemsize * count > len(data):
+                raise ValueError("%s: truncated segment" % path)
+            values = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += values.nbytes
+            return values
+
+        self.offsets = column("<i8", ALPHABET ** k + 1)
+        self.postings = column("<i4", n_postings)
+        self.kmer_counts = column("<i4", n)
+        self.sequence_offsets = column("<i8", n + 1)
+        self.sequences = column("u1", n_bytes)
+        self.name_offsets = column("<i8", n + 1)
+        self.names = column("u1", int(self.name_offsets[-1]) if n else 0)
+        self.deleted = np.zeros(n, dtype=bool)
+        if os.path.exists(deleted_name(path)):
+            self.deleted = np.fromfile(deleted_name(path), dtype=bool, count=n)
+
+    def name(self, row: int) -> str:
+        return self.names[self.name_offsets[row] : self.name_offsets[row + 1]].tobytes().decode("utf-8")
+
+    def sequence(self, row: int) -> str:
+        return self.sequences[self.sequence_offsets[row] : self.sequence_offsets[row + 1]].tobytes().decode("ascii")
+
+    def shared_kmers(self, query: np.ndarray) -> np.ndarray:
+        """Number of the (distinct) query k-mers in every template of the segment."""
+        starts, ends = self.offsets[query], self.offsets[query + 1]
+        hits = [self.postings[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+        if not hits:
+            return np.zeros(self.n, dtype=np.int64)
+        return np.bincount(np.concatenate(hits), minlength=self.n)
+
+
+def deleted_name(segment_path: str) -> str:
+    return segment_path[: -len(".kmi")] + ".del"
+
+
+def segment_paths(index_dir: str) -> List[str]:
+    return sorted(str(path) for path in Path(index_dir).glob("segment_*.kmi"))
+
+
+def load_segments(index_dir: str) -> List[Segment]:
+    segments = [Segment(path) for path in segment_paths(index_dir)]
+    if len({segment.k for segment in segments}) > 1:
+        raise ValueError("%s: segments built with different k" % index_dir)
+    return segments
+
+
+def live_templates(segments: List[Segment]) -> Dict[str, Tuple[int, int]]:
+    """{template id: (segment, row)} of the templates not replaced by a later segment."""
+    live: Dict[str, Tuple[int, int]] = {}
+    for s, segment in enumerate(segments):
+        for row in np.flatnonzero(~segment.deleted).tolist():
+            live[segment.name(row)] = (s, row)
+    return live
+
+
+def update_index(index_dir: str, templates: Dict[str, str], k: int = DEFAULT_K) -> Tuple[int, int]:
+    """
+    Add the templates that are new or whose sequence changed to the index at index_dir
+    (created if needed), merging the segments when there are more than MAX_SEGMENTS.
+    Returns (templates added, live templates in the index).
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    segments = load_segments(index_dir)
+    if segments and segments[0].k != k:
+        raise ValueError("%s was built with k = %d" % (index_dir, segments[0].k))
+    live = live_templates(segments)
+    changed = [
+        (name, seq) for name, seq in templates.items()
+        if name not in live or segments[live[name][0]].sequence(live[name][1]) != seq
+    ]
+    if not changed:
+        return 0, len(live)
+
+    replaced: Dict[int, List[int]] = {}
+    for name, _ in changed:
+        if name in live:
+            s, row = live[name]
+            replaced.setdefault(s, []).append(row)
+    number = int(Path(segment_paths(index_dir)[-1]).stem.split("_")[1]) + 1 if segments else 0
+    write_segment(os.path.join(index_dir, "segment_%04d.kmi" % number), changed, k)
+    for s, rows in replaced.items():
+        deleted = segments[s].deleted.copy()
+        deleted[rows] = True
+        tmp = deleted_name(segments[s].path) + ".tmp"
+        deleted.tofile(tmp)
+        os.replace(tmp, deleted_name(segments[s].path))
+
+    segments = load_segments(index_dir)
+    live = live_templates(segments)
+    if len(segments) > MAX_SEGMENTS:
+        merged = [(name, segments[s].sequence(row)) for name, (s, row) in live.items()]
+        old = [segment.path for segment in segments]
+        write_segment(os.path.join(index_dir, "segment_%04d.kmi" % (number + 1)), merged, k)
+        for path in old:
+            os.remove(path)
+            if os.path.exists(deleted_name(path)):
+                os.remove(deleted_name(path))
+    return len(changed), len(live)
+
+
+def search(
+    segments: List[Segment], target: str, top: int = 20, min_shared: int = 2
+) -> List[Tuple[str, int, int, float, str]]:
+    """
+    Rank the templates of the index for target. Returns up to top
+    (template id, template length, shared k-mers, approximate identity, sequence), best first.
+    """
+    if not segments:
+        return []
+    k = segments[0].k
+    query = kmer_codes(target, k)
+    candidates = []
+    for s, segment in enumerate(segments):
+        shared = segment.shared_kmers(query)
+        shared[segment.deleted] = 0
+        counts = segment.kmer_counts.astype(np.float64)
+        rows = np.flatnonzero(shared >= min_shared)
+        if not len(rows):
+            continue
+        smaller = np.minimum(counts[rows], len(query))
+        fraction = shared[rows] / smaller
+        chance = counts[rows] / ALPHABET ** k  # a query k-mer found in the template by chance
+        excess = np.clip((fraction - chance) / (1 - chance), 0.0, 1.0)
+        identity = excess ** (1.0 / k)
+        candidates += zip(identity.tolist(), shared[rows].tolist(), [s] * len(rows), rows.tolist())
+    candidates.sort(key=lambda c: (-c[0], -c[1]))
+    results = []
+    for identity, shared, s, row in candidates[:top]:
+        segment = segments[s]
+        seq = segment.sequence(row)
+        results.append((segment.name(row), len(seq), shared, identity, seq))
+    return results
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="k-mer index of a template library and template search for a target.")
+    sub = ap.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Create the index, or add new and changed templates to it")
+    build.add_argument("index", help="Index directory")
+    build.add_argument("sources", nargs="+", help="FASTA files (or .gz), directories of *.fasta, pdb_seqres.txt")
+    build.add_argument("--k", type=int, default=DEFAULT_K, help="k-mer length (default: %(default)s)")
+    query = sub.add_parser("query", help="Rank the templates of the index for a target")
+    query.add_argument("index", help="Index directory")
+    query.add_argument("target", help="FASTA of the TARGET (first record)")
+    query.add_argument("--top", type=int, default=20, help="Number of templates to report (default: %(default)s)")
+    query.add_argument("--min-shared", type=int, default=2,
+                       help="Leave out templates sharing fewer k-mers with the target (default: %(default)s)")
+    query.add_argument("--fasta-out", help="Also write the sequences of the templates found to this FASTA")
+    args = ap.parse_args()
+
+    if args.command == "build":
+        if not 1 <= args.k <= 6:
+            ap.error("--k must be between 1 and 6")
+        try:
+            templates = library_sequences(args.sources)
+            added, total = update_index(args.index, templates, args.k)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            return 1
+        print(f"Indexed {added} new or changed templates in {args.index} ({total} templates)")
+        return 0
+
+    try:
+        started = time.perf_counter()
+        segments = load_segments(args.index)
+        target = next(read_templates(Path(args.target)), None)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    if not segments:
+        print(f"ERROR: no index in {args.index}; run build first", file=sys.stderr)
+        return 1
+    if target is None:
+        print(f"ERROR: no sequence in {args.target}", file=sys.stderr)
+        return 2
+    results = search(segments, target[1], args.top, args.min_shared)
+    elapsed = time.perf_counter() - started
+
+    print("rank\ttemplate_id\tlength\tshared_kmers\tapprox_identity")
+    for rank, (name, length, shared, identity, _) in enumerate(results, 1):
+        print(f"{rank}\t{name}\t{length}\t{shared}\t{identity:.3f}")
+    if args.fasta_out:
+        with open(args.fasta_out, "w") as out:
+            for name, _, _, _, seq in results:
+                out.write(f">{name}\n{seq}\n")
+    print(f"{len(results)} templates for {target[0]} in {elapsed * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())